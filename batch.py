@@ -0,0 +1,111 @@
+import json
+import logging
+import sys
+import time
+import journal
+from deployment import NotFoundError
+
+logger = logging.getLogger('batch')
+
+STATUS_OK = 'ok'
+STATUS_FAILED = 'failed'
+STATUS_NOT_FOUND = 'not_found'
+STATUS_SKIPPED = 'skipped'
+
+
+def read_pairs(stream):
+    """
+    Reads (deployment group, deployment task) pairs, one pair per line separated by spaces or comma:
+        domain.ru_year _deploy_cert
+        domain2.ru_year,_certbot_acme
+    Empty lines and lines starting with '#' are skipped.
+    Returns list of (group, task), raises ValueError on invalid line
+    """
+    pairs = []
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.replace(',', ' ').split()
+        if len(parts) != 2:
+            raise ValueError('Line {}: expected deployment group and deployment task, got {!r}'.format(number, line))
+        pairs.append((parts[0], parts[1]))
+    return pairs
+
+
+def load_pairs(path):
+    # path: str - file with pairs or '-' for stdin
+    if path == '-':
+        return read_pairs(sys.stdin)
+    with open(path, 'r') as stream:
+        return read_pairs(stream)
+
+
+def run_batch(deployment_groups, pairs, config):
+    """
+    Runs all pairs one by one with the same deployment groups (discovery is done once)
+    Missing groups and tasks don't stop the batch, they are reported as 'not_found'.
+    If config['fail_fast'] is set, pairs after the first failed one are 'skipped'.
+    Returns list of reports:
+        [{'group': ..., 'task': ..., 'status': 'ok' | 'failed' | 'not_found' | 'skipped',
+          'exit_code': 0, 'playbooks': 3, 'started': ..., 'finished': ..., 'message': ...}, ...]
+    """
+    reports = []
+    failed = False
+    for group, task in pairs:
+        report = {'group': group, 'task': task, 'status': STATUS_SKIPPED, 'exit_code': None,
+                  'playbooks': 0, 'started': None, 'finished': None, 'message': None}
+        reports.append(report)
+        if failed and config.get('fail_fast'):
+            continue
+        try:
+            tasks = deployment_groups.get_tasks(group, task)
+        except NotFoundError as e:
+            report['message'] = str(e)
+            if config['skip_dg_notfound']:
+                logger.info(str(e))
+                report['status'] = STATUS_NOT_FOUND
+                report['exit_code'] = 0
+                continue
+            logger.error(str(e))
+            report['status'] = STATUS_NOT_FOUND
+            report['exit_code'] = 1
+            failed = True
+            continue
+        run_journal = None
+        if not config['dry_run']:
+            run_journal = journal.Journal.open(config, deployment_groups, [group], [task])
+        logger.info("Batch: group '{}', task '{}'".format(group, task))
+        report['playbooks'] = len(tasks)
+        report['started'] = time.time()
+        exit_code = deployment_groups.run(group, task, run_journal)
+        report['finished'] = time.time()
+        report['exit_code'] = exit_code
+        if exit_code == 0:
+            report['status'] = STATUS_OK
+        else:
+            report['status'] = STATUS_FAILED
+            failed = True
+    return reports
+
+
+def batch_exit_code(reports):
+    # 0 if all pairs finished successfully (or not found with skip_dg_notfound), otherwise 1
+    for report in reports:
+        if report['exit_code'] != 0:
+            return 1
+    return 0
+
+
+def format_reports(reports):
+    lines = []
+    for report in reports:
+        lines.append('{:<10} {} {}'.format(report['status'], report['group'], report['task']))
+    return '\n'.join(lines)
+
+
+def write_reports(reports, path):
+    # JSON lines, one line for every pair
+    with open(path, 'w') as stream:
+        for report in reports:
+            stream.write(json.dumps(report) + '\n')
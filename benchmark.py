@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""
+Benchmark of discovery and execution on a synthetic ansible tree.
+
+./benchmark.py generate /tmp/tree --playbooks 2000 - Generate tree
+./benchmark.py run --root-dir /tmp/tree - Benchmark existing tree
+./benchmark.py run --playbooks 2000 --gron-share 0.3 --output result.json - Generate tree in temp dir and benchmark it
+./benchmark.py startup --max-ms 150 - Startup time of commands without discovery, fails if it's slower
+
+Results are printed as JSON, so they can be compared between commits.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+import discovery
+from deployment import DeploymentGroups
+from gron import DEPLOYMENT_TASKS
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    generate_parser = subparsers.add_parser('generate', help="Generate synthetic tree")
+    generate_parser.add_argument('root_dir', help="Dir for the tree")
+    add_tree_arguments(generate_parser)
+    run_parser = subparsers.add_parser('run', help="Run benchmark")
+    run_parser.add_argument('--root-dir', help="Existing tree, generated in temp dir if not set")
+    run_parser.add_argument('--repeat', type=int, default=3, help="Repeats of each phase, the best time is used")
+    run_parser.add_argument('--stub-sleep', type=float, default=0.05, help="Runtime of stub ansible-playbook, seconds")
+    run_parser.add_argument('--parallel', type=int, default=4, help="--parallel for execution benchmark")
+    run_parser.add_argument('--output', help="Write JSON to the file instead of stdout")
+    add_tree_arguments(run_parser)
+    startup_parser = subparsers.add_parser('startup', help="Benchmark startup of gron.py")
+    startup_parser.add_argument('--repeat', type=int, default=10, help="Runs of every command, the median is used")
+    startup_parser.add_argument('--max-ms', type=float, help="Exit with code 1 if the median of any command is slower")
+    startup_parser.add_argument('--output', help="Write JSON to the file instead of stdout")
+    return parser.parse_args()
+
+
+def add_tree_arguments(parser):
+    parser.add_argument('--playbooks', type=int, default=500, help="Number of playbooks")
+    parser.add_argument('--gron-share', type=float, default=0.3, help="Share of playbooks with deployment tasks")
+    parser.add_argument('--plays', type=int, default=2, help="Plays per playbook")
+    parser.add_argument('--dgs', type=int, default=50, help="Number of deployment groups")
+    parser.add_argument('--dgs-per-task', type=int, default=3, help="Deployment groups per task of the play")
+    parser.add_argument('--global-share', type=float, default=0.2,
+                        help="Share of gron plays with _deployment_groups/#GLOBAL")
+    parser.add_argument('--vars-files-share', type=float, default=0.2,
+                        help="Share of gron plays which load deployment tasks from vars_files")
+    parser.add_argument('--vars-files', type=int, default=5, help="Number of shared vars files")
+    parser.add_argument('--tasks', type=int, default=30, help="Ansible tasks per play (file size)")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed")
+
+
+def _dg_name(index):
+    return 'domain{}.ru_year'.format(index)
+
+
+def _ansible_tasks(rnd, count):
+    lines = ['  tasks:']
+    for i in range(count):
+        lines.append('    - name: task {}'.format(i))
+        lines.append('      shell: echo {} > /tmp/{}'.format(rnd.random(), i))
+        lines.append('      args:')
+        lines.append('        creates: /tmp/{}'.format(i))
+        lines.append('      when: inventory_hostname is defined')
+    return lines
+
+
+def _deployment_groups_lines(rnd, params, indent):
+    lines = []
+    for dg in rnd.sample(range(params.dgs), min(params.dgs_per_task, params.dgs)):
+        lines.append('{}- dg: {}'.format(indent, _dg_name(dg)))
+        lines.append("{}  tags: ['certs']".format(indent))
+        lines.append('{}  cert_path: "/etc/ssl/{}.pem"'.format(indent, dg))
+    return lines
+
+
+def _gron_play(rnd, params, index):
+    lines = ['- hosts: "web{}-*.example.ru"'.format(index), '  vars:']
+    kind = rnd.random()
+    if kind < params.vars_files_share:
+        lines.append('    _vars_files: yes')
+        lines.append('  vars_files:')
+        lines.append("    - '../vars/gron{}.yml'".format(rnd.randrange(params.vars_files)))
+    elif kind < params.vars_files_share + params.global_share:
+        for task in DEPLOYMENT_TASKS[1:3]:
+            lines.append('    {}:'.format(task))
+            lines.append("      tags: ['{}']".format(task.strip('_')))
+            lines.append('      nolimit: true')
+            lines.append('      deployment_groups: "#GLOBAL"')
+        lines.append('    _deployment_groups:')
+        lines += _deployment_groups_lines(rnd, params, '      ')
+    else:
+        lines.append('    {}:'.format(DEPLOYMENT_TASKS[0]))
+        lines.append('      deployment_groups:')
+        lines += _deployment_groups_lines(rnd, params, '        ')
+    return lines
+
+
+def generate_tree(root_dir, params):
+    # Returns number of generated playbooks with deployment tasks
+    rnd = random.Random(params.seed)
+    os.makedirs(os.path.join(root_dir, 'vars'), exist_ok=True)
+    for i in range(params.vars_files):
+        lines = ['{}:'.format(DEPLOYMENT_TASKS[3]), '  deployment_groups:']
+        lines += _deployment_groups_lines(rnd, params, '    ')
+        with open(os.path.join(root_dir, 'vars', 'gron{}.yml'.format(i)), 'w') as stream:
+            stream.write('\n'.join(lines) + '\n')
+    gron_files = 0
+    for i in range(params.playbooks):
+        site_dir = os.path.join(root_dir, 'site{}'.format(i % 50))
+        os.makedirs(site_dir, exist_ok=True)
+        is_gron = rnd.random() < params.gron_share
+        gron_files += is_gron
+        lines = []
+        for play in range(params.plays):
+            if is_gron and play == 0:
+                lines += _gron_play(rnd, params, i)
+            else:
+                lines += ['- hosts: "app{}-{}.example.ru"'.format(i, play), '  vars:', '    app_port: 80']
+            lines += _ansible_tasks(rnd, params.tasks)
+        with open(os.path.join(site_dir, 'playbook{}.yml'.format(i)), 'w') as stream:
+            stream.write('\n'.join(lines) + '\n')
+        # Files which are skipped by the walk
+        if i % 10 == 0:
+            role_dir = os.path.join(site_dir, 'roles', 'role{}'.format(i), 'files')
+            os.makedirs(role_dir, exist_ok=True)
+            shutil.copy(os.path.join(site_dir, 'playbook{}.yml'.format(i)), role_dir)
+    return gron_files
+
+
+def _make_stub(directory, sleep):
+    path = os.path.join(directory, 'ansible-playbook-stub')
+    with open(path, 'w') as stream:
+        stream.write('#!/bin/sh\nsleep {}\n'.format(sleep))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    return path
+
+
+def _timeit(func, repeat):
+    # Returns (best wall time, cpu time of the best run, result)
+    best = None
+    for _ in range(repeat):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        result = func()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        if best is None or wall < best[0]:
+            best = (wall, cpu, result)
+    return best
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Commands which must not load discovery and yaml
+# '{plan}' is replaced by the plan of a small generated tree
+STARTUP_COMMANDS = {
+    'help': ['--help'],
+    'show_tags': ['-nc', '--show-tags'],
+    'invalid_arguments': ['-nc'],
+    'plan_in': ['-nc', '--plan-in', '{plan}', '-sg'],
+}
+# Modules which must not be imported by STARTUP_COMMANDS
+HEAVY_MODULES = ('yaml', 'discovery', 'deployment', 'executor', 'plan', 'daemon', 'concurrent.futures')
+# Commands which need some of HEAVY_MODULES: {command: modules which must not be imported}
+STARTUP_HEAVY_MODULES = {
+    'plan_in': ('yaml', 'discovery'),
+}
+
+
+def _imported_modules(cmd):
+    # Names of the modules imported by the command (python -X importtime)
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + cmd, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE)
+    modules = set()
+    for line in proc.stderr.decode('utf-8', errors='replace').splitlines():
+        if line.startswith('import time:') and '|' in line:
+            modules.add(line.split('|')[-1].strip())
+    return modules
+
+
+def run_startup_benchmark(args):
+    gron = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gron.py')
+    with tempfile.TemporaryDirectory(prefix='gron-startup-') as tmp_dir:
+        root_dir = os.path.join(tmp_dir, 'tree')
+        params = argparse.Namespace(playbooks=20, gron_share=0.5, plays=1, dgs=5, dgs_per_task=1, global_share=0,
+                                    vars_files_share=0, vars_files=1, tasks=1, seed=1)
+        generate_tree(root_dir, params)
+        plan_path = os.path.join(tmp_dir, 'plan.json')
+        subprocess.run([sys.executable, gron, '-nc', '--no-daemon', '--no-index', '--root-dir', root_dir,
+                        '--plan-out', plan_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        return _run_startup_commands(gron, plan_path, args)
+
+
+def _run_startup_commands(gron, plan_path, args):
+    commands = {}
+    failed = False
+    for name, gron_args in STARTUP_COMMANDS.items():
+        gron_args = [x.format(plan=plan_path) for x in gron_args]
+        cmd = [gron] + gron_args
+        times = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            subprocess.run([sys.executable] + cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append((time.perf_counter() - started) * 1000)
+        times.sort()
+        median = times[len(times) // 2]
+        heavy_modules = sorted(set(STARTUP_HEAVY_MODULES.get(name, HEAVY_MODULES)) & _imported_modules(cmd))
+        commands[name] = {
+            'args': gron_args,
+            'median_ms': round(median, 2),
+            'min_ms': round(times[0], 2),
+            'heavy_modules': heavy_modules,
+        }
+        if heavy_modules or (args.max_ms is not None and median > args.max_ms):
+            failed = True
+    # Baseline: the interpreter without gron
+    times = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'])
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    result = {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'interpreter_ms': round(times[len(times) // 2], 2),
+        'commands': commands,
+        'max_ms': args.max_ms,
+        'failed': failed,
+    }
+    return result, failed
+
+
+def run_benchmark(root_dir, stub, args):
+    config = {
+        'root_dir': root_dir,
+        'deployment_tasks': list(DEPLOYMENT_TASKS),
+        'environment': [],
+        'limit': None,
+        'no_index': True,
+        'jobs': 1,
+        'ansible_bin': stub,
+        'ansible_dry_run': False,
+        'ansible_debug': False,
+        'dry_run': False,
+        'skip_dg_notfound': False,
+        'debug': False,
+    }
+    phases = {}
+
+    def record(name, func, repeat=args.repeat):
+        wall, cpu, result = _timeit(func, repeat)
+        phases[name] = {'wall': round(wall, 6), 'cpu': round(cpu, 6)}
+        return result
+
+    yaml_files = record('walk', lambda: discovery._find_yaml_files(config))
+    gron_files = record('prefilter', lambda: [x for x in yaml_files if discovery._is_gron_file(x, config)])
+    documents = record('parse', lambda: [discovery.read_yaml(x, headers_only=True) for x in gron_files])
+
+    def expand():
+        result = {}
+        for yaml_file, yaml_data in zip(gron_files, documents):
+            plays, _ = discovery._expand_yaml_data(yaml_file, yaml_data, config)
+            for tasks_data in plays:
+                discovery._update_deployment_groups(tasks_data, result)
+        return result
+    raw_deployment_groups = record('expand', expand)
+    deployment_groups = record('tasks', lambda: DeploymentGroups(raw_deployment_groups, config))
+    record('commands', lambda: [task['cmd'] for dtasks in deployment_groups.values()
+                                for tasks in dtasks.values() for task in tasks])
+    record('show', lambda: str(deployment_groups))
+    record('show_dg', lambda: deployment_groups.show_dg())
+    record('discovery_total', lambda: discovery.get_deployment_groups(config))
+
+    # Execution: the group/task with the biggest number of playbooks
+    counts = [(len(tasks), group, task) for group, dtasks in deployment_groups.items()
+              for task, tasks in dtasks.items()]
+    execution = {}
+    if counts:
+        size, group, task = max(counts)
+        for parallel in sorted(set([1, args.parallel])):
+            config['parallel'] = parallel
+            fresh_groups = discovery.get_deployment_groups(config)
+            wall, cpu, exit_code = _timeit(lambda: fresh_groups.run(group, task), 1)
+            execution['parallel_{}'.format(parallel)] = {'wall': round(wall, 6), 'exit_code': exit_code}
+        execution['playbooks'] = size
+        execution['stub_sleep'] = args.stub_sleep
+    tasks_count = sum(len(tasks) for dtasks in deployment_groups.values() for tasks in dtasks.values())
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'params': {key: value for key, value in vars(args).items() if key not in ('command', 'output')},
+        'counts': {
+            'yaml_files': len(yaml_files),
+            'gron_files': len(gron_files),
+            'deployment_groups': len(deployment_groups),
+            'tasks': tasks_count,
+        },
+        'phases': phases,
+        'execution': execution,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    logging.basicConfig(level=logging.WARNING, format="%(message)s", stream=sys.stderr)
+    if args.command == 'generate':
+        gron_files = generate_tree(args.root_dir, args)
+        print('Generated {} playbooks ({} with deployment tasks) in {}'.format(
+            args.playbooks, gron_files, args.root_dir))
+        sys.exit(0)
+    failed = False
+    if args.command == 'startup':
+        result, failed = run_startup_benchmark(args)
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix='gron-benchmark-')
+        try:
+            root_dir = args.root_dir
+            if not root_dir:
+                root_dir = os.path.join(tmp_dir, 'tree')
+                generate_tree(root_dir, args)
+            stub = _make_stub(tmp_dir, args.stub_sleep)
+            result = run_benchmark(root_dir, stub, args)
+        finally:
+            shutil.rmtree(tmp_dir)
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        print(output)
+    sys.exit(1 if failed else 0)
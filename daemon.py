@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import threading
+import time
+import plan
+from deployment import json_default
+from index import file_signature
+
+logger = logging.getLogger('daemon')
+
+DEFAULT_SOCKET_PATH = '~/.cache/gron/gron.sock'
+DEFAULT_POLL_INTERVAL = 2
+# Seconds to wait for the daemon to accept the request and for each part of the reply
+DEFAULT_TIMEOUT = 10
+# Config keys which change the result of discovery and commands,
+# requests with other values are not served by the daemon
+CONFIG_KEYS = ('root_dir', 'exclude', 'max_depth', 'git', 'changed_since', 'deployment_tasks', 'environment',
+               'limit', 'ansible_bin', 'ansible_dry_run', 'ansible_debug')
+
+
+def _socket_path(config):
+    return os.path.expanduser(config.get('socket_path') or DEFAULT_SOCKET_PATH)
+
+
+def _config_fingerprint(config):
+    return {key: config.get(key) for key in CONFIG_KEYS}
+
+
+def get_deployment_groups(config, groups=None):
+    """
+    Client: requests deployment groups from the running daemon.
+    groups: list | None - deployment groups to load, all by default
+    Returns DeploymentGroups or None if the daemon isn't running, doesn't reply in time
+    or is started with another config
+    """
+    request = {'config': _config_fingerprint(config), 'groups': groups}
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # socket.timeout is OSError, the usual discovery is done if the daemon hangs
+    client.settimeout(config.get('daemon_timeout') or DEFAULT_TIMEOUT)
+    try:
+        client.connect(_socket_path(config))
+        client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        client.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = client.recv(1024 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except OSError as e:
+        logger.debug('Daemon is not available: {}'.format(str(e)))
+        return None
+    finally:
+        client.close()
+    try:
+        response = json.loads(b''.join(chunks).decode('utf-8'))
+    except ValueError as e:
+        logger.warning('Invalid response from daemon: {}'.format(str(e)))
+        return None
+    if response.get('status') != 'ok':
+        logger.debug('Daemon refused request: {}'.format(response.get('status')))
+        return None
+    logger.info('Deployment groups loaded from daemon')
+    return plan.deployment_groups_from_data(response['groups'], response['vars_files'], config)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            self._reply({'status': 'invalid request'})
+            return
+        self._reply(self.server.daemon.handle_request(request))
+
+    def _reply(self, response):
+        self.wfile.write(json.dumps(response, separators=(',', ':'), default=json_default).encode('utf-8'))
+
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """
+    Keeps deployment groups in memory and rediscovers them when files under root_dir change.
+    Files are polled every config['poll_interval'] seconds, unchanged files are taken
+    from the discovery index, so only changed files are parsed again.
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._fingerprint = _config_fingerprint(config)
+        self._snapshot = None
+        # Snapshot of the files on which the last discovery failed, it isn't repeated until they change
+        self._failed_snapshot = None
+        self.deployment_groups = None
+
+    def _take_snapshot(self):
+        # Signatures of all yaml files and vars files, used to detect changes
+        import discovery
+        snapshot = {}
+        for path in discovery._iter_yaml_files(self._config):
+            snapshot[path] = file_signature(path)
+        if self.deployment_groups is not None:
+            for vars_files in self.deployment_groups.sources.values():
+                for path in vars_files:
+                    snapshot[path] = file_signature(path)
+        return snapshot
+
+    def refresh(self):
+        snapshot = self._take_snapshot()
+        if snapshot == self._snapshot or snapshot == self._failed_snapshot:
+            return
+        import discovery
+        started = time.time()
+        try:
+            self.deployment_groups = discovery.get_deployment_groups(self._config)
+        except discovery.DiscoveryError:
+            # The last good deployment groups are served until the files are fixed
+            self._failed_snapshot = snapshot
+            raise
+        self._failed_snapshot = None
+        # vars files are known only after discovery
+        self._snapshot = self._take_snapshot()
+        logger.info('Deployment groups reloaded: {} groups, {:.2f}s'.format(
+            len(self.deployment_groups), time.time() - started))
+
+    def handle_request(self, request):
+        if request.get('config') != self._fingerprint:
+            return {'status': 'config mismatch'}
+        deployment_groups = self.deployment_groups
+        groups = request.get('groups')
+        if groups is None:
+            groups = list(deployment_groups)
+        return {
+            'status': 'ok',
+            'groups': {x: deployment_groups[x] for x in groups if x in deployment_groups},
+            'vars_files': deployment_groups.sources,
+        }
+
+    def _poll(self):
+        interval = self._config.get('poll_interval') or DEFAULT_POLL_INTERVAL
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error('Error while reloading deployment groups: {}'.format(str(e)))
+            except SystemExit:
+                # The poll thread must not stop, otherwise old deployment groups are served forever
+                logger.error('Error while reloading deployment groups')
+
+    def serve(self):
+        path = _socket_path(self._config)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+                logger.error('Daemon is already running: {}'.format(path))
+                return 1
+            except OSError:
+                os.remove(path)
+            finally:
+                probe.close()
+        if not self._config.get('debug'):
+            logging.getLogger('discovery').setLevel(logging.WARNING)
+        import discovery
+        try:
+            self.refresh()
+        except discovery.DiscoveryError:
+            return 1
+        server = _UnixServer(path, _RequestHandler)
+        server.daemon = self
+        poller = threading.Thread(target=self._poll, daemon=True)
+        poller.start()
+        logger.info('Listening on {}'.format(path))
+        signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(path)
+        return 0
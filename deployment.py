@@ -1,17 +1,45 @@
-import yaml
-import copy
 import json
 import logging
 import sys
 import os
 import subprocess
-import pprint
+import tempfile
+import time
+import metrics
+import sharding
+from executor import Executor
 
 logger = logging.getLogger('deployment')
 
+# Keys of deployment group which are not passed to ansible-playbook as variables
+DG_RESERVED_KEYS = ("args", "tags", "hosts", "playbook")
+# Variable with the list of deployment groups for coalesced playbook runs
+COALESCE_VAR = 'gron_deployment_groups'
+
+
+class NotFoundError(Exception):
+    # Deployment group or its deployment task not found
+    pass
+
+
+def json_default(obj):
+    # 'default' for json.dump, serializes tasks as dicts and other objects (dates) as strings
+    if isinstance(obj, Task):
+        return obj.to_dict()
+    return str(obj)
+
+
+def extra_var_arg(key, value):
+    # '-e' argument of ansible-playbook with the variable of deployment group
+    if len(str(value).split(' ')) > 0:
+        return '-e \'{}="{}"\''.format(key, value)
+    else:
+        return '-e "{}={}"'.format(key, value)
+
+
 class DeploymentGroups(dict):
     
-    def __init__(self, raw_deployment_groups, config):
+    def __init__(self, raw_deployment_groups, config, sources=None):
         """
         raw_deployment_groups: dict
             returned from _find_deployment_groups(...) (discovery.py)
@@ -28,19 +56,22 @@ class DeploymentGroups(dict):
                     ]
                 }, ...
             }
-
+        sources: dict
+            {playbook: [vars_files]} - files which deployment groups are loaded from
         """
         self._config = config
+        self.sources = sources or {}
         self.update(raw_deployment_groups)
         self._create_task_objects()
 
     def _create_task_objects(self):
         for dg_name, dtasks in self.items():
             for task_name, tasks in dtasks.items():
-                dtasks[task_name] = [Task(task, self._config) for task in tasks]
+                dtasks[task_name] = [Task(play, dg, self._config) for play, dg in tasks]
 
     def __str__(self):
-        return yaml.dump(json.loads(json.dumps(self)),)
+        import yaml
+        return yaml.dump(json.loads(json.dumps(self, default=json_default)),)
 
     def show_dg(self):
         """
@@ -50,14 +81,31 @@ class DeploymentGroups(dict):
             deployment_group2:
                 task: _deployment_task2
         """
-        result =  ''
+        lines = []
         for dg_name, tags in self.items():
-            result += '{}\n'.format(dg_name)
+            lines.append(dg_name)
             for tag, tag_tasks in tags.items():
-                result += "  {}\n".format(tag)
+                lines.append("  {}".format(tag))
                 for task in tag_tasks:
                     if "playbook" in task:
-                        result += "    - {}\n".format(task["playbook"])
+                        lines.append("    - {}".format(task["playbook"]))
+        lines.append('')
+        return '\n'.join(lines)
+
+    def filter(self, group_prefix=None, task=None):
+        """
+        Returns DeploymentGroups with groups which names start with group_prefix
+        and only with the deployment task 'task' (tasks objects are shared)
+        """
+        result = DeploymentGroups({}, self._config, self.sources)
+        for dg_name, dtasks in self.items():
+            if group_prefix and not dg_name.startswith(group_prefix):
+                continue
+            if task is not None:
+                if task not in dtasks:
+                    continue
+                dtasks = {task: dtasks[task]}
+            result[dg_name] = dtasks
         return result
 
     def show_tags(self):
@@ -68,91 +116,339 @@ class DeploymentGroups(dict):
         return result
 
 
-    def run(self, group, dt):
+    def get_tasks(self, group, dt):
+        # Returns tasks of the deployment task 'dt' of the group, raises NotFoundError
         if group not in self:
-            msg = "Deployment group '{}' doesn't exists".format(group)
-            if not self._config['skip_dg_notfound']:
-                logger.error(msg)
-                sys.exit(1)
-            else:
-                logger.info(msg)
-                sys.exit(0)
+            raise NotFoundError("Deployment group '{}' doesn't exists".format(group))
         if dt not in self[group]:
-            msg = "Group '{}' with deployment task '{}' not found".format(group, dt)
-            if not self._config['skip_dg_notfound']:
-                logger.error(msg)
-                sys.exit(1)
+            raise NotFoundError("Group '{}' with deployment task '{}' not found".format(group, dt))
+        return self[group][dt]
+
+    def _not_found(self, msg):
+        # Returns exit code for not found group or task
+        if not self._config['skip_dg_notfound']:
+            logger.error(msg)
+            return 1
+        logger.info(msg)
+        return 0
+
+    def run(self, group, dt, journal=None):
+        """
+        Runs all tasks of the deployment task 'dt' of the group
+        journal: journal.Journal - finished tasks are recorded, tasks completed in previous runs are skipped
+        If config['fail_fast'] is set, tasks after the first failed one are skipped.
+        Returns exit code (1 if the group or the task not found, 0 with config['skip_dg_notfound'])
+        """
+        try:
+            tasks = self.get_tasks(group, dt)
+        except NotFoundError as e:
+            return self._not_found(str(e))
+        parallel = self._config.get('parallel') or 1
+        if parallel > 1 and len(tasks) > 1:
+            return Executor(self._config, parallel, journal).run(tasks)
+        exit_code = 0
+        for i, task in enumerate(tasks):
+            if journal is not None and journal.completed(task):
+                logger.info('Skip {}, finished in previous run'.format(task['cmd']))
+                continue
+            started = time.time()
+            shards = sharding.shard_task(task, self._config)
+            if shards:
+                returncode = Executor(self._config, len(shards), journal).run(shards)
             else:
-                logger.info(msg)
-                sys.exit(0)
-        for task in self[group][dt]:
-            task.run()
+                returncode = task.run()
+            if journal is not None:
+                journal.record(task, started, time.time(), returncode)
+            if returncode != 0 and exit_code == 0:
+                exit_code = returncode
+            if returncode != 0 and self._config.get('fail_fast'):
+                for skipped_task in tasks[i + 1:]:
+                    logger.warning('Skip {}, fail fast'.format(skipped_task['cmd']))
+                break
+        return exit_code
 
+    def run_pipeline(self, groups, chain, journal=None):
+        """
+        groups: list - deployment groups
+        chain: list - deployment tasks in order of execution, eg ['_certbot_acme', '_certbot_upload', '_deploy_cert']
+        journal: journal.Journal - see run()
+        Runs tasks of all groups as a dependency graph: a task of the group starts as soon as
+        all playbooks of the previous task of the same group finished successfully.
+        If a playbook failed, next tasks of its group are skipped, other groups continue.
+        Returns exit code
+        """
+        # Groups of the caller aren't changed, missing groups are dropped from the copy
+        groups = list(groups)
+        for group in list(groups):
+            if group not in self:
+                msg = "Deployment group '{}' doesn't exists".format(group)
+                if self._not_found(msg):
+                    return 1
+                groups.remove(group)
+        tasks = []
+        deps = []
+        # (groups, dt) for each item of tasks
+        owners = []
+        # Temporary files with variables of coalesced runs
+        vars_files = []
+        previous_stage = {group: set() for group in groups}
+        for dt in chain:
+            stage = []
+            for group in groups:
+                if dt not in self[group]:
+                    logger.info("Group '{}' with deployment task '{}' not found, skip".format(group, dt))
+                    continue
+                for task in self[group][dt]:
+                    stage.append(([group], task))
+            if self._config.get('coalesce'):
+                stage = self._coalesce(stage, vars_files)
+            current_stage = {}
+            for task_groups, task in stage:
+                task_deps = set()
+                for group in task_groups:
+                    task_deps |= previous_stage[group]
+                    current_stage.setdefault(group, set()).add(len(tasks))
+                tasks.append(task)
+                deps.append(task_deps)
+                owners.append((task_groups, dt))
+            previous_stage.update(current_stage)
+        parallel = self._config.get('parallel') or 1
+        executor = Executor(self._config, parallel, journal)
+        try:
+            exit_code = executor.run(tasks, deps)
+        finally:
+            for path in vars_files:
+                os.remove(path)
+        for group in groups:
+            failed = [dt for (owners_groups, dt), result in zip(owners, executor.results)
+                      if group in owners_groups and result not in (0, None)]
+            if failed:
+                logger.error("Group '{}' failed on task '{}'".format(group, failed[0]))
+            else:
+                logger.info("Group '{}' finished".format(group))
+        return exit_code
 
-class Task(dict):
-    def __init__(self, task, config):
+    def _coalesce(self, stage, vars_files):
         """
-        task: dict
-            {
-              'dg': 'domain.ru_year',
-              'tags': ['nginx_ssl_conf'],
-              'args': ['-e \'dg="domain.ru_year"\''],
-              'hosts': ['host-*.domain.ru'], 
-              'playbook': '/home/user/ansible/nginx/nginx.yml'
-            }
+        stage: list of ([group], task) - tasks of one deployment task of the pipeline
+        vars_files: list - paths of created temporary files are added to it
+        Merges tasks of different groups with the same playbook, hosts, tags and arguments into
+        one task, variables of groups are passed as a list in COALESCE_VAR (-e @file.json).
+        Returns list of (groups, task)
         """
+        buckets = []
+        buckets_by_key = {}
+        for task_groups, task in stage:
+            key = (task['playbook'], task.get('hosts'), tuple(task.get('tags') or []), tuple(task.base_args()))
+            for bucket in buckets_by_key.setdefault(key, []):
+                if task_groups[0] not in bucket[0]:
+                    break
+            else:
+                bucket = ([], [])
+                buckets_by_key[key].append(bucket)
+                buckets.append(bucket)
+            bucket[0].append(task_groups[0])
+            bucket[1].append(task)
+        result = []
+        for bucket_groups, bucket_tasks in buckets:
+            if len(bucket_tasks) == 1:
+                result.append((bucket_groups, bucket_tasks[0]))
+                continue
+            first = bucket_tasks[0]
+            payload = {COALESCE_VAR: [x.extra_vars() for x in bucket_tasks]}
+            fd, path = tempfile.mkstemp(prefix='gron-', suffix='.json')
+            with os.fdopen(fd, 'w') as stream:
+                json.dump(payload, stream, default=str)
+            vars_files.append(path)
+            logger.debug('Coalesced groups {}, playbook {}, variables {}'.format(
+                bucket_groups, first['playbook'], path))
+            task = Task.from_dict({
+                'dg': ','.join(bucket_groups),
+                'tags': first.get('tags'),
+                'args': first.base_args() + ['-e @{}'.format(path)],
+                'hosts': first.get('hosts'),
+                'playbook': first['playbook'],
+            }, self._config)
+            result.append((bucket_groups, task))
+        return result
+
+
+class Task(object):
+    """
+    Run of ansible-playbook for one deployment group.
+    Compact object: the deployment group dict and the play dict (playbook, hosts, global tags and args)
+    are shared with discovery data and other tasks of the play, arguments and command are built on demand.
+    Supports read access like dict:
+        {
+          'dg': 'domain.ru_year',
+          'tags': ['nginx_ssl_conf'],
+          'args': ['-e \'dg="domain.ru_year"\''],
+          'hosts': 'host-*.domain.ru',
+          'playbook': '/home/user/ansible/nginx/nginx.yml',
+          'cmd': '/usr/bin/ansible-playbook /home/user/ansible/nginx/nginx.yml -t ...'
+        }
+    """
+    __slots__ = ('play', 'dg', '_config', '_args', '_cmd')
+
+    def __init__(self, play, dg, config):
+        """
+        play: dict - {'playbook': ..., 'hosts': ..., 'tags': <global tags>, 'args': <global args>}
+        dg: dict - deployment group from playbook ({'dg': 'domain.ru_year', 'tags': [...], ...})
+        """
+        self.play = play
+        self.dg = dg
         self._config = config
-        self.update(task)
-        self._configure()
+        self._args = None
+        self._cmd = None
+
+    @classmethod
+    def from_dict(cls, task, config):
+        # Task from the dict with resolved args (and cmd): plan file, daemon, coalesced tasks
+        dg = {key: value for key, value in task.items() if key not in ('args', 'hosts', 'playbook', 'cmd')}
+        play = {'playbook': task['playbook'], 'hosts': task.get('hosts'), 'tags': None, 'args': None}
+        result = cls(play, dg, config)
+        result._args = list(task.get('args', []))
+        result._cmd = task.get('cmd')
+        return result
+
+    def with_hosts(self, hosts, shard=None):
+        # Copy of the task limited by another hosts pattern (shard of the hosts, see sharding.py)
+        play = dict(self.play, hosts=hosts, shard=shard)
+        task = Task(play, self.dg, self._config)
+        task._args = self._args
+        return task
+
+    def _get_args(self):
+        if self._args is None:
+            args = list(self.dg.get('args', []))
+            args.extend(self._config['environment'])
+            if self.play.get('args'):
+                args.extend(self.play['args'])
+            args.extend(extra_var_arg(key, value) for key, value in self.dg.items()
+                        if key not in DG_RESERVED_KEYS)
+            if self._config['ansible_dry_run'] and '-C' not in args:
+                args.append('-C')
+            if self._config['ansible_debug'] and '-D' not in args:
+                args.append('-D')
+            self._args = args
+        return self._args
+
+    def _get_tags(self):
+        global_tags = self.play.get('tags')
+        if not global_tags:
+            return self.dg.get('tags')
+        return list(self.dg.get('tags') or []) + global_tags
+
+    def _get_hosts(self):
+        hosts = self.play.get('hosts')
+        if isinstance(hosts, list):
+            hosts = ':'.join(hosts)
+        return hosts
 
     def _configure(self):
         cmd = '{bin} {playbook}'
-        if isinstance(self['hosts'], list):
-            self['hosts'] = ':'.join(self['hosts'])
         ansible_bin = self._config.get('ansible_bin')
         if not ansible_bin:
             ansible_bin = '/usr/bin/ansible-playbook'
         cmd = cmd.format(
             bin=ansible_bin,
-            playbook=self['playbook'], 
+            playbook=self.play['playbook'],
         )
-        if self.get('tags',False):
-            cmd += ' -t \'{tags}\''.format(tags=','.join(self['tags']))
-        if self.get('hosts',False):
-            cmd += ' -l {hosts}'.format(hosts='"{}"'.format(self['hosts']))
-        if 'args' in self:
-            if self._config['ansible_dry_run'] and '-C' not in self['args']:
-                self['args'].append('-C')
-            if self._config['ansible_debug'] and '-D' not in self['args']:
-                self['args'].append('-D')
-            cmd_args = ' {args}'
-            cmd += cmd_args.format(args=' '.join(self['args']))
-        self['cmd'] = cmd
-    
+        tags = self._get_tags()
+        if tags:
+            cmd += ' -t \'{tags}\''.format(tags=','.join(tags))
+        hosts = self._get_hosts()
+        if hosts:
+            cmd += ' -l {hosts}'.format(hosts='"{}"'.format(hosts))
+        args = self._get_args()
+        cmd_args = ' {args}'
+        cmd += cmd_args.format(args=' '.join(args))
+        self._cmd = cmd
+
+    def __getitem__(self, key):
+        if key == 'cmd':
+            if self._cmd is None:
+                self._configure()
+            return self._cmd
+        if key == 'args':
+            return self._get_args()
+        if key == 'tags':
+            tags = self._get_tags()
+            if tags is None and 'tags' not in self.dg:
+                raise KeyError(key)
+            return tags
+        if key == 'hosts':
+            return self._get_hosts()
+        if key == 'playbook':
+            return self.play['playbook']
+        return self.dg[key]
+
+    def __contains__(self, key):
+        if key in ('cmd', 'args', 'hosts', 'playbook'):
+            return True
+        if key == 'tags':
+            return 'tags' in self.dg or bool(self.play.get('tags'))
+        return key in self.dg
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        keys = [key for key in self.dg if key not in DG_RESERVED_KEYS]
+        if 'tags' in self:
+            keys.append('tags')
+        return keys + ['args', 'hosts', 'playbook', 'cmd']
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __str__(self):
+        return str(self.to_dict())
+
+    def extra_vars(self):
+        # Variables of deployment group which are passed to ansible-playbook
+        return {key: value for key, value in self.dg.items() if key not in DG_RESERVED_KEYS}
+
+    def base_args(self):
+        # Arguments of ansible-playbook without variables of deployment group
+        extra_args = set(extra_var_arg(key, value) for key, value in self.extra_vars().items())
+        return [x for x in self.get('args', []) if x not in extra_args]
+
+    def get_env(self):
+        # Environment for ansible-playbook without variables of the current virtualenv
+        new_env = {}
+        for key, value in os.environ.items():
+            if not key.startswith('VIRTUALENVWRAPPER') and 'VIRTUALENV' not in key:
+                if 'VIRTUAL_ENV' not in key:
+                    new_env[key] = value
+        return new_env
+
     def run(self):
+        # Returns exit code of ansible-playbook (0 in dry run mode)
         if not self.get('cmd'):
             logger.error('No "cmd" field in runned task (see debug)')
             logger.debug(str(self))
-            sys.exit(1)
+            return 1
         if not self._config['dry_run']:
-            env = os.environ
-            new_env = {}
-            for key, value in env.items():
-                if not key.startswith('VIRTUALENVWRAPPER') and 'VIRTUALENV' not in key:
-                    if 'VIRTUAL_ENV' not in key:
-                        new_env[key] = value
             logger.info('Run {}'.format(self['cmd']))
+            started = time.perf_counter()
             proc = subprocess.Popen(
                 self['cmd'],
                 shell=True,
                 stdout=sys.stdout,
                 stderr=sys.stderr,
-                env=new_env,
+                env=self.get_env(),
             )
             proc.communicate()
+            metrics.task_finished(self, time.perf_counter() - started, proc.returncode)
             if proc.returncode != 0:
                 logger.error("Error! {}".format(self['cmd']))
+            return proc.returncode
         else:
             logger.info('Dry run: {}'.format(self['cmd']))
-
-
+            return 0
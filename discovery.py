@@ -4,20 +4,34 @@ try:
 except ImportError:
     from yaml import Loader
 from pathlib import Path
-import pprint
 import logging
 from deployment import DeploymentGroups
+from index import DiscoveryIndex
+from play_headers import load_play_headers
+import metrics
+import git_source
 import os
-import copy
-import sys
+import fnmatch
+import collections
+import mmap
+import re
+import types
+import time
 
 
 
 logger = logging.getLogger('discovery')
 
-def get_deployment_groups(config):
+
+class DiscoveryError(Exception):
+    # Discovery can't be finished, the message is already logged
+    pass
+
+def get_deployment_groups(config, group=None, task=None):
     '''
     main func
+    If group and task are set, only files which can contain them are parsed,
+    and only this group with this task is returned (targeted discovery)
     Parses yaml files and returns struct 'deployment groups'
     Example data for ansible 'vars:':
         vars:
@@ -28,87 +42,440 @@ def get_deployment_groups(config):
                       args: ['arg1', 'arg2']
     returned data from  _find_deployment_groups()
     '''
-    yaml_files = _find_yaml_files(config)
-    raw_deployment_groups = _find_deployment_groups(yaml_files, config)
-    deployment_groups = DeploymentGroups(raw_deployment_groups, config)
+    sources = {}
+    # Walk, prefilter, parse and expansion of the files are one streaming pipeline, every stage
+    # is timed as a separate phase, see _find_deployment_groups
+    raw_deployment_groups = _find_deployment_groups(config, group, task, sources)
+    if group is not None and task is not None and task not in raw_deployment_groups.get(group, {}):
+        # Other tasks of the group are needed to report the error like full discovery does
+        logger.debug("Task '{}' of group '{}' not found, full discovery".format(task, group))
+        raw_deployment_groups = _find_deployment_groups(config, sources=sources)
+        if group in raw_deployment_groups:
+            raw_deployment_groups = {group: raw_deployment_groups[group]}
+        else:
+            raw_deployment_groups = {}
+    if config.get('changed_since'):
+        raw_deployment_groups = _filter_changed(raw_deployment_groups, sources, _changed_sources(config))
+    with metrics.phase('tasks'):
+        deployment_groups = DeploymentGroups(raw_deployment_groups, config, sources)
+    if metrics.enabled():
+        metrics.update_counts({
+            'deployment_groups': len(deployment_groups),
+            'tasks': sum(len(tasks) for dtasks in deployment_groups.values() for tasks in dtasks.values()),
+        })
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Memory ceiling: peak RSS {:.1f} MiB'.format(metrics.peak_rss_bytes() / 1048576))
     return deployment_groups
 
-def _find_deployment_groups(yaml_files, config):
+def _find_deployment_groups(config, group=None, task=None, sources=None):
     # Getting deployment groups from yaml files
     '''
-    yaml_files: set | list
     config: dict
+    group: str - deployment group for targeted discovery
+    task: str - deployment task for targeted discovery
+    sources: dict - if set, it's filled with {playbook: [vars_files]} for files with deployment tasks
+
+    Files are processed by the pipeline of generators: walk -> index lookup -> prefilter -> parse -> expand,
+    every file is merged into the result as soon as it's parsed. Neither the list of files nor the parsed
+    documents are kept: a document is released when deployment groups are taken from it.
+    Time of every stage is recorded as the metrics phase with the name of the stage (see STAGES).
 
     Returned :
     { 
         '<deployment_group': {
             '<deployment_task>': [
-                {
-                    'dg': <deployment_group>,
-                    'tags': ['tag1', 'tag2'] ,
-                    'args': ['arg1', 'arg2'],
-                    'playbook': '/home/user/ansible/.../playbook.yml',
-                    ....
-                },
+                (
+                    {'playbook': '/home/user/ansible/.../playbook.yml', 'hosts': ..., 'tags': ..., 'args': ...},
+                    {
+                        'dg': <deployment_group>,
+                        'tags': ['tag1', 'tag2'] ,
+                        'args': ['arg1', 'arg2'],
+                        ....
+                    },
+                ),
             ],
         },
     }
+    (play, deployment group) pairs, see _parse_hosts_vars
 
     '''
     logger.info('Parsing yaml files...')
-    deployment_tasks = config['deployment_tasks']
     deployment_groups = {}
+    index = None
+    if not config.get('no_index'):
+        index = DiscoveryIndex.load(config)
+    counts = collections.Counter()
+    # stats are collected for the whole process (several discoveries run in the daemon and
+    # after a failed targeted discovery), only the changes made by this discovery are reported
+    stats_before = stats.copy()
+    targeted = group is not None and task is not None
+    walk_counts = collections.Counter()
+    items = _lookup_index(_iter_yaml_files(config, walk_counts), index, counts)
+    if targeted:
+        logger.debug("Targeted discovery: group '{}', task '{}'".format(group, task))
+        items = _filter_target_files(items, group, task)
+    for yaml_file, (plays, vars_files, warnings), parsed in _parse_yaml_files(items, config):
+        if parsed:
+            counts['parsed_files'] += 1
+            if index:
+                index.put(yaml_file, plays, vars_files, warnings)
+        else:
+            # Files from the index aren't parsed, their warnings are logged again
+            for level, message in warnings:
+                logger.log(level, message)
+        if plays and sources is not None:
+            sources[yaml_file] = vars_files
+        for tasks_data in plays:
+            if targeted:
+                tasks_data = _filter_tasks_data(tasks_data, group, task)
+            _update_deployment_groups(tasks_data, deployment_groups)
+    # The walk is finished before the last files are parsed in parallel mode,
+    # the summary is logged after their logs like in serial mode
+    _log_walk_counts(walk_counts)
+    if index:
+        # Only entries of the files which weren't walked are dropped,
+        # files rejected by the targeted prefilter keep their entries
+        index.save()
+    delta = stats - stats_before
+    if metrics.enabled():
+        for stage in STAGES:
+            metrics.add_phase_time(stage, delta[stage + '_seconds'], delta[stage + '_cpu'])
+        metrics.update_counts({
+            'yaml_files': counts['yaml_files'],
+            'parsed_files': counts['parsed_files'],
+            'index_hits': counts['index_hits'],
+            'prefilter_rejected': delta['prefilter_rejected'],
+            'vars_cache_hits': delta['vars_cache_hits'],
+            'vars_cache_misses': delta['vars_cache_misses'],
+        })
+        if sources is not None:
+            metrics.update_counts({'gron_files': len(sources)})
+    logger.debug('Prefilter: checked {} files, rejected {}'.format(
+        delta['prefilter_checked'], delta['prefilter_rejected']))
+    logger.debug('Vars files cache: hits {}, misses {}'.format(
+        delta['vars_cache_hits'], delta['vars_cache_misses']))
+    if targeted:
+        logger.debug('Targeted prefilter: rejected {} files'.format(delta['target_rejected']))
+    return deployment_groups
+
+def _lookup_index(yaml_files, index, counts):
+    # Generator, yields (yaml_file, cached (plays, vars_files, warnings) or None)
+    timed = metrics.enabled()
     for yaml_file in yaml_files:
-        yaml_data = read_yaml(yaml_file, config, pass_errors=True)
-        if not yaml_data:
-            continue
-        for hosts_item in yaml_data:
-            if not isinstance(hosts_item, dict) or 'vars' not in hosts_item:
-                continue
-            if not hosts_item['vars']:
-                continue
-            elif 'hosts' not in hosts_item:
-                continue
-            if '_vars_files' in hosts_item['vars']:
-                for vars_file in hosts_item['vars_files']:
-                    if not vars_file.startswith('/'):
-                        vars_file = vars_file.split('/')
-                        #Берет директорию где лежит плейбук и подставляет в корень vars файла
-                        vars_file = yaml_file.split('/')[:-1] + vars_file
-                        vars_file = '/'.join(vars_file)
-                    hosts_item['vars'].update(read_yaml(vars_file, config))
-            if not hosts_item.get('vars',None):
+        counts['yaml_files'] += 1
+        entry = None
+        if index and timed:
+            clock = _stage_clock()
+            entry = index.get(yaml_file)
+            _add_stage_time('index', clock)
+        elif index:
+            entry = index.get(yaml_file)
+        if entry is not None:
+            counts['index_hits'] += 1
+        yield yaml_file, entry
+
+def _filter_target_files(items, group, task):
+    # Generator, skips files which can't contain the group and the task (targeted discovery)
+    timed = metrics.enabled()
+    for yaml_file, cached in items:
+        if cached is None:
+            clock = _stage_clock() if timed else None
+            target = _is_target_file(yaml_file, group, task)
+            if timed:
+                _add_stage_time('prefilter', clock)
+            if not target:
                 continue
-            hosts = hosts_item['hosts']
-            tasks_data = _parse_hosts_vars(config,
-                                          hosts_item['vars'],
-                                          deployment_tasks,
-                                          playbook=yaml_file,
-                                          hosts=hosts)
-            if tasks_data:
-                _update_deployment_groups(tasks_data, deployment_groups)
-    return deployment_groups 
-    
-def _parse_hosts_vars(config, hosts_vars, deployment_tasks, playbook, **kwargs):
+        yield yaml_file, cached
+
+# Stages of the discovery pipeline, their time is collected in stats in the process which runs the stage
+# (parsing workers send stats with the results): stats['<stage>_seconds'] - wall time, stats['<stage>_cpu'] - CPU time
+# Stages are timed only if metrics are enabled
+STAGES = ('walk', 'index', 'prefilter', 'parse', 'expand')
+
+def _stage_clock():
+    return time.perf_counter(), time.process_time()
+
+def _add_stage_time(stage, clock):
+    # Adds the time since clock to the stage, returns the clock for the next stage
+    now = _stage_clock()
+    stats[stage + '_seconds'] += now[0] - clock[0]
+    stats[stage + '_cpu'] += now[1] - clock[1]
+    return now
+
+# Files sent to the parsing process at once
+PARSE_CHUNK_SIZE = 16
+
+def _parse_yaml_files(items, config):
+    """
+    Generator
+    items: iterable of (yaml_file, cached result or None)
+    Yields (yaml_file, (plays, vars_files, warnings), parsed) in the order of items, cached results are passed
+    as is (parsed is False), other files are parsed with _parse_yaml_file().
+    If config['jobs'] > 1, files are parsed in a process pool by chunks of PARSE_CHUNK_SIZE files,
+    at most 2 chunks per process are in flight, so memory doesn't depend on the number of files.
+    Logs of the workers are replayed in the main process in the order of files,
+    so output is the same as in serial mode.
+    """
+    jobs = config.get('jobs') or 1
+    if jobs < 0:
+        jobs = os.cpu_count() or 1
+    if jobs == 1:
+        for yaml_file, cached in items:
+            if cached is not None:
+                yield yaml_file, cached, False
+            else:
+                yield yaml_file, _parse_yaml_file_timed(yaml_file, config), True
+        return
+    # The pool is started with the first chunk with 2 files to parse, a warm index doesn't need it
+    executor = None
+    window = collections.deque()
+    try:
+        for chunk in _iter_chunks(items, PARSE_CHUNK_SIZE):
+            misses = [yaml_file for yaml_file, cached in chunk if cached is None]
+            future = None
+            if executor is None and len(misses) > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                logger.debug('Parsing files with {} processes'.format(jobs))
+                executor = ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                                               initargs=(config, metrics.enabled()))
+            if executor is not None and misses:
+                future = executor.submit(_parse_yaml_chunk_worker, misses)
+            window.append((chunk, future))
+            if len(window) > jobs * 2:
+                yield from _chunk_results(*window.popleft(), config)
+        while window:
+            yield from _chunk_results(*window.popleft(), config)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+def _iter_chunks(items, size):
+    # Splits items into lists with at most 'size' files to parse, cached files stay in their places
+    chunk = []
+    misses = 0
+    for item in items:
+        chunk.append(item)
+        if item[1] is None:
+            misses += 1
+        if misses == size or len(chunk) == size * 16:
+            yield chunk
+            chunk = []
+            misses = 0
+    if chunk:
+        yield chunk
+
+def _chunk_results(chunk, future, config):
+    # Yields results of the chunk like _parse_yaml_files(), files are parsed here if future is None
+    results = iter(future.result()) if future is not None else None
+    for yaml_file, cached in chunk:
+        if cached is not None:
+            yield yaml_file, cached, False
+            continue
+        if results is None:
+            yield yaml_file, _parse_yaml_file_timed(yaml_file, config), True
+            continue
+        result, records, worker_stats, seconds, error = next(results)
+        stats.update(worker_stats)
+        metrics.file_parsed(yaml_file, seconds)
+        for record in records:
+            record_logger = logging.getLogger(record.name)
+            if record_logger.isEnabledFor(record.levelno):
+                record_logger.handle(record)
+        if error is not None:
+            raise error
+        yield yaml_file, result, True
+
+def _parse_yaml_file_timed(yaml_file, config):
+    if not metrics.enabled():
+        return _parse_yaml_file(yaml_file, config)
+    started = time.perf_counter()
+    result = _parse_yaml_file(yaml_file, config)
+    metrics.file_parsed(yaml_file, time.perf_counter() - started)
+    return result
+
+
+class _RecordsHandler(logging.Handler):
+    # Collects log records in the worker process
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        self.records.append(record)
+
+
+_worker_config = None
+_worker_handler = None
+
+def _init_worker(config, timed):
+    # timed: bool - metrics are enabled in the main process, stages of parsing are timed
+    global _worker_config, _worker_handler
+    _worker_config = config
+    if timed:
+        metrics.enable()
+    _worker_handler = _RecordsHandler()
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(_worker_handler)
+    root_logger.setLevel(logging.DEBUG)
+
+def _parse_yaml_file_worker(yaml_file):
+    # Returns (result, log records, counters, parse time, exception)
+    _worker_handler.records = []
+    stats.clear()
+    result = None
+    error = None
+    started = time.perf_counter()
+    try:
+        result = _parse_yaml_file(yaml_file, _worker_config)
+    except BaseException as e:
+        error = e
+    return result, _worker_handler.records, dict(stats), time.perf_counter() - started, error
+
+def _parse_yaml_chunk_worker(yaml_files):
+    # Returns list of _parse_yaml_file_worker() results, files after the failed one aren't parsed
+    results = []
+    for yaml_file in yaml_files:
+        results.append(_parse_yaml_file_worker(yaml_file))
+        if results[-1][4] is not None:
+            break
+    return results
+
+def _parse_yaml_file(yaml_file, config):
+    """
+    Parses one yaml file
+    Returns tuple (plays, vars_files, warnings):
+        plays - list of _parse_hosts_vars() results, one item for each play with deployment tasks
+        vars_files - list of loaded vars files (used for invalidation of index)
+        warnings - list of [level, message] logged while parsing, the index logs them again on hit
+    """
+    warnings = []
+    logger.debug('Open {}'.format(yaml_file))
+    timed = metrics.enabled()
+    clock = _stage_clock() if timed else None
+    gron_file = _is_gron_file(yaml_file, config)
+    if timed:
+        clock = _add_stage_time('prefilter', clock)
+    if not gron_file:
+        logger.debug("{} is not gron file, skip".format(yaml_file))
+        return [], [], warnings
+    # The document is released on return, only the plays and deployment groups taken from it are kept
+    try:
+        yaml_data = _load_yaml(yaml_file, headers_only=True)
+    except yaml.YAMLError as e:
+        message = 'Ошибка при открытии файла {}: {}'.format(yaml_file, str(e))
+        logging.error(message)
+        warnings.append([logging.ERROR, message])
+        yaml_data = None
+    if timed:
+        clock = _add_stage_time('parse', clock)
+    plays, vars_files = _expand_yaml_data(yaml_file, yaml_data, config, warnings)
+    if timed:
+        _add_stage_time('expand', clock)
+    return plays, vars_files, warnings
+
+def _expand_yaml_data(yaml_file, yaml_data, config, warnings=None):
+    # Finds deployment tasks in the plays of loaded yaml file, returns (plays, vars_files) of _parse_yaml_file
+    # warnings: list - if set, logged warnings are appended to it
+    deployment_tasks = config['deployment_tasks']
+    plays = []
+    loaded_vars_files = []
+    if not yaml_data:
+        return plays, loaded_vars_files
+    for hosts_item in yaml_data:
+        if not isinstance(hosts_item, dict) or 'vars' not in hosts_item:
+            continue
+        if not hosts_item['vars']:
+            continue
+        elif 'hosts' not in hosts_item:
+            continue
+        play_vars = hosts_item['vars']
+        if '_vars_files' in play_vars:
+            # vars files are merged into a copy, the document isn't modified
+            play_vars = dict(play_vars)
+            for vars_file in hosts_item['vars_files']:
+                if not vars_file.startswith('/'):
+                    vars_file = vars_file.split('/')
+                    #Берет директорию где лежит плейбук и подставляет в корень vars файла
+                    vars_file = yaml_file.split('/')[:-1] + vars_file
+                    vars_file = '/'.join(vars_file)
+                loaded_vars_files.append(vars_file)
+                play_vars.update(_load_vars_file(vars_file, config))
+        if not play_vars:
+            continue
+        hosts = hosts_item['hosts']
+        tasks_data = _parse_hosts_vars(config,
+                                      play_vars,
+                                      deployment_tasks,
+                                      playbook=yaml_file,
+                                      warnings=warnings,
+                                      hosts=hosts)
+        if tasks_data:
+            plays.append(tasks_data)
+    return plays, loaded_vars_files
+
+_vars_files_cache = collections.OrderedDict()
+DEFAULT_VARS_FILES_CACHE_SIZE = 256
+
+def _load_vars_file(path, config):
+    '''
+    Loads vars file with cache (LRU, config['vars_files_cache_size'] files),
+    the key is the real path of the file, cached data is valid while mtime and size are the same.
+    Returns read-only view of the cached data.
+    '''
+    real_path = os.path.realpath(path)
+    stat = os.stat(real_path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _vars_files_cache.get(real_path)
+    if cached is not None and cached[0] == signature:
+        stats['vars_cache_hits'] += 1
+        _vars_files_cache.move_to_end(real_path)
+        data = cached[1]
+    else:
+        stats['vars_cache_misses'] += 1
+        data = read_yaml(path, config)
+        _vars_files_cache[real_path] = (signature, data)
+        cache_size = config.get('vars_files_cache_size') or DEFAULT_VARS_FILES_CACHE_SIZE
+        while len(_vars_files_cache) > cache_size:
+            _vars_files_cache.popitem(last=False)
+    if isinstance(data, dict):
+        return types.MappingProxyType(data)
+    return data
+
+def _parse_hosts_vars(config, hosts_vars, deployment_tasks, playbook, warnings=None, **kwargs):
     """
     config: dict 
     hosts_vars: dict - (vars: from ansible hosts' set)
     deployment_tasks: set | list -  available deployment group's names
     playbook: string  - path to playbook
-    kwargs : kwargs  - variables for -e flag in ansible-playbook
+    warnings: list - if set, logged warnings are appended to it as [level, message]
+    kwargs : kwargs  - values of the play (hosts)
 
     Finds tasks in 'vars:' and returns:
     {
-        '<task>': [ 
-                    {
-                        'dg': 'domain.ru_year',
-                        'tags': ...,
-                        ...
-                     },
-                ],
-        '<task>': [{}],
+        '<task>': {
+            'play': {
+                'playbook': '/home/user/ansible/nginx/nginx.yml',
+                'hosts': 'host-*.domain.ru', # None if nolimit, config['limit'] if set
+                'tags': ['tag1'], # global tags of the task or None
+                'args': ['arg1'], # global args of the task or None
+            },
+            'deployment_groups': [
+                {
+                    'dg': 'domain.ru_year',
+                    'tags': ...,
+                    ...
+                },
+            ],
+        },
         ...
     }
+    Deployment groups are not copied, 'play' is shared by all of them.
+    Tasks (deployment.Task) build the arguments of ansible-playbook from them.
     """
     if isinstance(hosts_vars, list):
         return
@@ -125,99 +492,271 @@ def _parse_hosts_vars(config, hosts_vars, deployment_tasks, playbook, **kwargs):
             message = "Error. Task '{}' has no data, file: {}"
             message = message.format(dt, playbook)
             logger.error(message)
-            if config.get('debug'):
-                raise Exception(message)
-            else:
-                sys.exit(1)
+            raise DiscoveryError(message)
+        global_args = data.get('args', None)
+        global_tags = data.get('tags', None)
+        play = {'playbook': playbook, 'tags': global_tags or None, 'args': global_args or None}
+        play.update(kwargs)
+        if data.get('nolimit', False):
+            play['hosts'] = None
+        if config['limit']:
+            play['hosts'] = config['limit']
         if dt not in result:
-            result[dt] = []
+            result[dt] = {'play': play, 'deployment_groups': []}
         if 'deployment_groups' not in data and not global_dg:
             message = "Metadata format is invalid. deployment_groups not found in task '{}', file {}"
-            logger.warning(message.format(dt, playbook))
+            _warning(message.format(dt, playbook), warnings)
             continue
         elif global_dg:
             message = "Warning, global deployment groups used. File: {}"
             logger.debug(message.format(playbook))
-            data['deployment_groups'] = global_dg
-        global_args = data.get('args', None)
-        global_tags = data.get('tags', None)
+        # data isn't modified, it can be shared with other plays (vars files cache)
+        task_deployment_groups = global_dg if global_dg else data['deployment_groups']
         # Adding global args
         if global_tags:
             logger.debug("Warning, global ansible tags used. File {}".format(playbook))
         if global_args:
             logger.debug("Warning, global ansible args used. File {}".format(playbook))
-        for dg_original in data['deployment_groups']:
-            dg = copy.deepcopy(dg_original)
-            if not 'args' in dg:
-                dg['args'] = []
-            # Adding cli args
-            if len(config['environment']) > 0:
-                dg['args'] += config['environment']
-            # Adding from kwargs
-            for key,value in kwargs.items():
-                dg[key] = value
-            dg['playbook'] = playbook
-            if data.get('nolimit', False):
-                dg['hosts'] = None
-            if config['limit']:
-                dg['hosts'] = config['limit']
-            if global_args:
-                dg['args'] += global_args
-            if global_tags:
-                if not 'tags' in dg:
-                    dg['tags'] = []
-                dg['tags'] += global_tags
+        for dg in task_deployment_groups:
             if not 'dg' in dg:
                 message = "Metadata format is invalid. 'dg' key not found in deployment task: '{}', file{}"
-                logger.warning(message.format(dt, playbook))
+                _warning(message.format(dt, playbook), warnings)
                 logger.debug(dg)
                 continue
-            if not 'tags' in dg and not dg.get('tags', None) and not data.get('notags', False):
+            if not 'tags' in dg and not global_tags and not data.get('notags', False):
                 message = "Metadata format is invalid. 'tags' key not found in deployment group: '{}', файл {}"
-                logger.warning(message.format(dt, playbook))
+                _warning(message.format(dt, playbook), warnings)
                 logger.debug(dg)
                 continue
-            #Магия. Добавление всех items DG как environment для запуска плейбука
-            for key, value in dg.items():
-                if key in ("args","tags","hosts","playbook"):
-                    continue
-                if len(str(value).split(' ')) > 0:
-                    dg['args'].append('-e \'{}="{}"\''.format(key,value))
-                else:
-                    dg['args'].append('-e "{}={}"'.format(key,value))
-
-            result[dt].append(dg)
+            result[dt]['deployment_groups'].append(dg)
     return result
 
+def _warning(message, warnings):
+    logger.warning(message)
+    if warnings is not None:
+        warnings.append([logging.WARNING, message])
+
+def _filter_tasks_data(tasks_data, group, task):
+    # Keeps only deployment group 'group' of the task 'task' in _parse_hosts_vars() result
+    if task not in tasks_data:
+        return {}
+    return {task: {
+        'play': tasks_data[task]['play'],
+        'deployment_groups': [x for x in tasks_data[task]['deployment_groups'] if x['dg'] == group],
+    }}
+
 def _update_deployment_groups(tasks_data, deployment_groups):
     #Modifying dictionary 'deployment_grous', merging with _parse_hosts_vars
     #Description of 'deployment_groups' format  in function _find_deployment_groups
-    for task, _deployment_groups in tasks_data.items():
-        for deployment_group in _deployment_groups:
+    for task, task_data in tasks_data.items():
+        play = task_data['play']
+        for deployment_group in task_data['deployment_groups']:
             dg_name = deployment_group['dg']
             if dg_name not in deployment_groups:
                 deployment_groups[dg_name] = {}
             if task not in deployment_groups[dg_name]:
                 deployment_groups[dg_name][task] = []
-            deployment_groups[dg_name][task].append(deployment_group)
+            deployment_groups[dg_name][task].append((play, deployment_group))
     return deployment_groups
 
 
-def _find_yaml_files(config):
-    #Finding all files in config['root_dir'] with extensions from config['extensions'] 
+DEFAULT_EXCLUDE = ['.git', '.hg', '.svn', 'roles/*/files', 'collections', 'molecule', 'venv', '.venv', '.tox']
+
+
+def _get_root_dir(config):
     root_dir = config.get('root_dir')
     if not root_dir:
         root_dir = "~/ansible-ng"
-    extensions = ['.yml', '.yaml']
     if root_dir.startswith('~/'):
         root_dir = Path(root_dir).home().joinpath(root_dir[2:])
-    logger.info("Search for files in {} with extensions '{}'".format(root_dir, extensions))
-    finded_files = []
-    for extension in extensions:
-        extension = "**/*{}".format(extension)
-        finded_files += [str(x) for x in Path(root_dir).glob(extension)]
-    finded_files = [x for x in finded_files if os.path.isfile(x)]
-    return finded_files
+    return str(Path(root_dir))
+
+
+def _find_yaml_files(config):
+    # List of the files of _iter_yaml_files()
+    return list(_iter_yaml_files(config))
+
+
+def _iter_yaml_files(config, walk_counts=None):
+    #Generator, yields all files in config['root_dir'] with extensions '.yml' and '.yaml' in sorted order
+    #Directories matched by config['exclude'] and deeper than config['max_depth'] are skipped
+    #If config['git'] is set, files are taken from git index instead of walking root_dir
+    #walk_counts: Counter - if set, it's filled with numbers of found and skipped files and the caller
+    #logs them with _log_walk_counts(), otherwise they are logged when the walk is finished
+    root_dir = _get_root_dir(config)
+    extensions = ('.yml', '.yaml')
+    exclude = config.get('exclude')
+    if exclude is None:
+        exclude = DEFAULT_EXCLUDE
+    max_depth = config.get('max_depth')
+    log_counts = walk_counts is None
+    if log_counts:
+        walk_counts = collections.Counter()
+    if config.get('git'):
+        yield from _iter_git_files(root_dir, extensions, exclude, max_depth, walk_counts)
+        if log_counts:
+            _log_walk_counts(walk_counts)
+        return
+    logger.info("Search for files in {} with extensions '{}'".format(root_dir, list(extensions)))
+    timed = metrics.enabled()
+    # Entries of a directory are sorted by name with '/' appended to directories and pushed in reverse order,
+    # so files are yielded in the order of sorted paths without sorting of the whole list.
+    # (is directory, path, path relative to root_dir, depth)
+    stack = [(True, root_dir, '', 0)]
+    while stack:
+        is_dir, path, rel_path, depth = stack.pop()
+        if not is_dir:
+            walk_counts['files'] += 1
+            yield path
+            continue
+        # Only the walk itself is timed, not the stages which consume the files
+        clock = _stage_clock() if timed else None
+        children = _scan_dir(path, rel_path, depth, extensions, exclude, max_depth, walk_counts)
+        children.sort(reverse=True)
+        stack.extend(x[1:] for x in children)
+        if timed:
+            _add_stage_time('walk', clock)
+    if log_counts:
+        _log_walk_counts(walk_counts)
+
+
+def _log_walk_counts(walk_counts):
+    if walk_counts['git']:
+        logger.info('Found {} files in git index, skipped {} files'.format(
+            walk_counts['files'], walk_counts['skipped_files']))
+    else:
+        logger.info('Found {} files, skipped {} directories and {} files'.format(
+            walk_counts['files'], walk_counts['skipped_dirs'], walk_counts['skipped_files']))
+
+
+def _scan_dir(path, rel_path, depth, extensions, exclude, max_depth, walk_counts):
+    # Returns [(sort key, is directory, path, path relative to root_dir, depth)] of the directory entries to walk
+    try:
+        with os.scandir(path) as it:
+            entries = list(it)
+    except OSError as e:
+        logger.warning('Unable to read directory {}: {}'.format(path, str(e)))
+        return []
+    if any(entry.name == 'pyvenv.cfg' for entry in entries):
+        # Python virtualenv
+        logger.debug('Skip virtualenv {}'.format(path))
+        walk_counts['skipped_dirs'] += 1
+        return []
+    children = []
+    for entry in entries:
+        entry_rel_path = entry.name if not rel_path else rel_path + '/' + entry.name
+        if entry.is_dir(follow_symlinks=False):
+            if _is_excluded(entry_rel_path, entry.name, exclude):
+                logger.debug('Skip directory {}'.format(entry.path))
+                walk_counts['skipped_dirs'] += 1
+            elif max_depth is not None and depth >= max_depth:
+                walk_counts['skipped_dirs'] += 1
+            else:
+                children.append((entry.name + '/', True, entry.path, entry_rel_path, depth + 1))
+        elif not entry.name.endswith(extensions) or not entry.is_file():
+            walk_counts['skipped_files'] += 1
+        elif _is_excluded(entry_rel_path, entry.name, exclude):
+            walk_counts['skipped_files'] += 1
+        else:
+            children.append((entry.name, False, entry.path, entry_rel_path, depth))
+    return children
+
+
+def _iter_git_files(root_dir, extensions, exclude, max_depth, walk_counts):
+    #Generator, yields files from git index of root_dir, filtered like in _iter_yaml_files
+    #Paths in the index are sorted, so files are yielded in sorted order
+    walk_counts['git'] = 1
+    logger.info("Search for files in git index of {} with extensions '{}'".format(root_dir, list(extensions)))
+    timed = metrics.enabled()
+    try:
+        clock = _stage_clock() if timed else None
+        tracked_files = git_source.tracked_files(root_dir)
+        if timed:
+            _add_stage_time('walk', clock)
+    except git_source.GitError as e:
+        logger.error('Unable to read git index: {}'.format(str(e)))
+        raise DiscoveryError('Unable to read git index: {}'.format(str(e)))
+    # {relative dir: excluded}, python virtualenvs are skipped
+    excluded_dirs = {'': False}
+    for rel_path in tracked_files:
+        if rel_path.endswith('pyvenv.cfg'):
+            rel_dir, _, name = rel_path.rpartition('/')
+            if name == 'pyvenv.cfg':
+                logger.debug('Skip virtualenv {}'.format(rel_dir))
+                excluded_dirs[rel_dir] = True
+    for rel_path in tracked_files:
+        clock = _stage_clock() if timed else None
+        path = _git_file_path(root_dir, rel_path, extensions, exclude, max_depth, excluded_dirs)
+        if timed:
+            _add_stage_time('walk', clock)
+        if path is None:
+            walk_counts['skipped_files'] += 1
+            continue
+        walk_counts['files'] += 1
+        yield path
+
+
+def _git_file_path(root_dir, rel_path, extensions, exclude, max_depth, excluded_dirs):
+    # Returns path of the tracked file or None if it's skipped
+    # excluded_dirs: dict - {relative dir: excluded}, filled by this function
+    parts = rel_path.split('/')
+    if not parts[-1].endswith(extensions):
+        return None
+    if max_depth is not None and len(parts) - 1 > max_depth:
+        return None
+    rel_dir = ''
+    for part in parts[:-1]:
+        rel_dir = part if not rel_dir else rel_dir + '/' + part
+        if rel_dir not in excluded_dirs:
+            excluded_dirs[rel_dir] = _is_excluded(rel_dir, part, exclude)
+        if excluded_dirs[rel_dir]:
+            return None
+    path = root_dir + '/' + rel_path
+    if _is_excluded(rel_path, parts[-1], exclude) or not os.path.isfile(path):
+        # Files deleted from the working tree are still in the index
+        return None
+    return path
+
+
+def _changed_sources(config):
+    # Normalized paths of the files under root_dir changed since config['changed_since'] commit
+    root_dir = _get_root_dir(config)
+    try:
+        changed_files = git_source.changed_files(root_dir, config['changed_since'])
+    except git_source.GitError as e:
+        logger.error('Unable to get changed files: {}'.format(str(e)))
+        raise DiscoveryError('Unable to get changed files: {}'.format(str(e)))
+    logger.info("Changed since '{}': {} files".format(config['changed_since'], len(changed_files)))
+    return set(os.path.normpath(os.path.join(root_dir, x)) for x in changed_files)
+
+
+def _filter_changed(raw_deployment_groups, sources, changed):
+    # Keeps only playbooks which changed or which vars files changed
+    result = {}
+    for dg_name, dtasks in raw_deployment_groups.items():
+        for task, tasks in dtasks.items():
+            tasks = [x for x in tasks if _is_changed(x[0]['playbook'], sources, changed)]
+            if tasks:
+                result.setdefault(dg_name, {})[task] = tasks
+    return result
+
+
+def _is_changed(playbook, sources, changed):
+    for path in [playbook] + list(sources.get(playbook, [])):
+        if os.path.normpath(path) in changed:
+            return True
+    return False
+
+
+def _is_excluded(rel_path, name, exclude):
+    #Patterns without '/' are matched against the name, others against the end of the relative path
+    for pattern in exclude:
+        if '/' not in pattern:
+            if fnmatch.fnmatch(name, pattern):
+                return True
+        elif fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(rel_path, '*/' + pattern):
+            return True
+    return False
 
 
 def open_file(path):
@@ -226,31 +765,78 @@ def open_file(path):
         try:
             return stream.read()
         except Exception as e:
-            logging.error('Error while open file {}: {}'.format(path), str(e))
+            logging.error('Error while open file {}: {}'.format(path, str(e)))
 
 
-def _is_gron_file(file_src, config):
+# Counters of discovery, shown in debug mode
+stats = collections.Counter()
+
+_gron_patterns = {}
+
+def _get_gron_pattern(required_strings):
+    # One compiled regexp for all required strings, cached by the list of strings
+    key = tuple(required_strings)
+    pattern = _gron_patterns.get(key)
+    if pattern is None:
+        alternatives = sorted(set(x.encode('utf-8') for x in required_strings), key=len, reverse=True)
+        pattern = re.compile(b'|'.join(re.escape(x) for x in alternatives))
+        _gron_patterns[key] = pattern
+    return pattern
+
+
+def _is_gron_file(path, config):
+    # Prefilter: searches deployment tasks names in the raw bytes of the file without decoding it
     required_strings = config['deployment_tasks'] + ['_vars_files',]
-    for task in required_strings:
-        if task in file_src:
-            return True
-    return False
+    pattern = _get_gron_pattern(required_strings)
+    stats['prefilter_checked'] += 1
+    with open(str(path), 'rb') as stream:
+        if os.fstat(stream.fileno()).st_size == 0:
+            stats['prefilter_rejected'] += 1
+            return False
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if pattern.search(data) is None:
+                stats['prefilter_rejected'] += 1
+                return False
+    return True
 
 
+def _is_target_file(path, group, task):
+    # Prefilter for targeted discovery: file must contain the task and the group names,
+    # or the names of global deployment groups and vars files which can bring them
+    task_pattern = _get_gron_pattern([task, '_vars_files'])
+    group_pattern = _get_gron_pattern([group, '_deployment_groups', '_vars_files'])
+    with open(str(path), 'rb') as stream:
+        if os.fstat(stream.fileno()).st_size == 0:
+            stats['target_rejected'] += 1
+            return False
+        with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if task_pattern.search(data) is None or group_pattern.search(data) is None:
+                stats['target_rejected'] += 1
+                return False
+    return True
 
-def read_yaml(path, config=None, pass_errors=False):
+
+def read_yaml(path, config=None, pass_errors=False, headers_only=False):
+    # headers_only - load only 'hosts', 'vars' and 'vars_files' of plays (see play_headers.py)
     logger.debug('Open {}'.format(path))
-    file_src = open_file(path)
-    if not file_src:
-        return
     if config:
-        if not _is_gron_file(file_src, config):
+        if not _is_gron_file(path, config):
             logger.debug("{} is not gron file, skip".format(path))
             return
+    return _load_yaml(path, pass_errors, headers_only)
+
+
+def _load_yaml(path, pass_errors=False, headers_only=False):
+    # read_yaml() without prefilter
+    file_src = open_file(path)
+    if not file_src:
+        return
     try:
+        if headers_only:
+            return load_play_headers(file_src, Loader)
         return yaml.load(file_src, Loader=Loader)
     except yaml.YAMLError as e:
         if not pass_errors:
             raise e
         else:
-            logging.error('Ошибка при открытии файла {}: {}'.format(path), str(e))
+            logging.error('Ошибка при открытии файла {}: {}'.format(path, str(e)))
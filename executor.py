@@ -0,0 +1,275 @@
+import fnmatch
+import logging
+import subprocess
+import sys
+import threading
+import time
+import metrics
+import sharding
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+logger = logging.getLogger('executor')
+
+_output_lock = threading.Lock()
+
+WILDCARDS = sharding.WILDCARDS
+
+
+def _parse_hosts(hosts):
+    """
+    hosts: str | None - ansible hosts pattern ('host1.domain.ru:web-*.domain.ru')
+    Returns set of lowercased host patterns or None if hosts can't be resolved without inventory
+    (no limit, groups, regexps, 'all', ranges)
+    """
+    if not hosts:
+        return None
+    result = set()
+    for term in hosts.replace(',', ':').split(':'):
+        term = term.strip().lower()
+        if not term or term[0] in ('!', '&'):
+            # Exclusions and intersections only reduce the set of hosts
+            continue
+        kind = sharding.term_kind(term)
+        if kind not in (sharding.TERM_HOST, sharding.TERM_GLOB) or '[' in term:
+            # Globs are matched by prefix and suffix, ranges can't be matched so
+            return None
+        result.add(term)
+    if not result:
+        return None
+    return result
+
+
+def _literal_parts(pattern):
+    # Returns literal prefix and suffix of the glob pattern
+    first = min(pattern.find(x) for x in WILDCARDS if x in pattern)
+    last = max(pattern.rfind(x) for x in WILDCARDS if x in pattern)
+    return pattern[:first], pattern[last + 1:]
+
+
+def _pattern_info(pattern):
+    # (pattern, literal prefix, literal suffix), prefix and suffix are None if pattern isn't a glob
+    if not any(x in pattern for x in WILDCARDS):
+        return pattern, None, None
+    prefix, suffix = _literal_parts(pattern)
+    return pattern, prefix, suffix
+
+
+def _host_patterns(hosts):
+    # _parse_hosts() with precomputed _pattern_info(), hosts of the task are parsed once
+    patterns = _parse_hosts(hosts)
+    if patterns is None:
+        return None
+    return [_pattern_info(x) for x in sorted(patterns)]
+
+
+def _infos_may_intersect(a, b):
+    a, a_prefix, a_suffix = a
+    b, b_prefix, b_suffix = b
+    if a_prefix is None and b_prefix is None:
+        return a == b
+    if a_prefix is None:
+        return fnmatch.fnmatchcase(a, b)
+    if b_prefix is None:
+        return fnmatch.fnmatchcase(b, a)
+    if not (a_prefix.startswith(b_prefix) or b_prefix.startswith(a_prefix)):
+        return False
+    return a_suffix.endswith(b_suffix) or b_suffix.endswith(a_suffix)
+
+
+def _patterns_may_intersect(a, b):
+    return _infos_may_intersect(_pattern_info(a), _pattern_info(b))
+
+
+def _host_patterns_conflict(patterns1, patterns2):
+    # The same as hosts_conflict() for _host_patterns() results
+    if patterns1 is None or patterns2 is None:
+        return True
+    for info1 in patterns1:
+        for info2 in patterns2:
+            if _infos_may_intersect(info1, info2):
+                return True
+    return False
+
+
+def hosts_conflict(hosts1, hosts2):
+    """
+    Returns True if two hosts patterns may have common hosts.
+    Patterns which can't be resolved without inventory conflict with everything.
+    """
+    return _host_patterns_conflict(_host_patterns(hosts1), _host_patterns(hosts2))
+
+
+def _conflicts(tasks):
+    """
+    Returns list of sets: indexes of the tasks whose hosts may intersect with hosts of the task.
+    Hosts are parsed once for every distinct pattern. Instead of comparing all pairs, patterns are
+    looked up by literal and by every prefix of the literal: two globs intersect only if the literal
+    prefix of one is a prefix of the other, a host matches a glob only if it starts with its prefix.
+    """
+    # {hosts: indexes of the tasks}
+    by_hosts = {}
+    for i, task in enumerate(tasks):
+        by_hosts.setdefault(task.get('hosts'), []).append(i)
+    groups = list(by_hosts.values())
+    patterns = [_host_patterns(hosts) for hosts in by_hosts]
+    # {host: [group]}, {literal prefix of glob: [(group, pattern info)]}
+    literals = {}
+    globs = {}
+    unresolved = set()
+    for group, infos in enumerate(patterns):
+        if infos is None:
+            unresolved.update(groups[group])
+            continue
+        for info in infos:
+            if info[1] is None:
+                literals.setdefault(info[0], []).append(group)
+            else:
+                globs.setdefault(info[1], []).append((group, info))
+    # Groups of tasks with the same hosts conflict with each other
+    group_conflicts = [{group} if patterns[group] is not None else set() for group in range(len(groups))]
+    for group, infos in enumerate(patterns):
+        for info in infos or ():
+            # The literal of a host or the literal prefix of a glob
+            literal = info[0] if info[1] is None else info[1]
+            if info[1] is None:
+                for other in literals[literal]:
+                    group_conflicts[group].add(other)
+                    group_conflicts[other].add(group)
+            for end in range(len(literal) + 1):
+                for other, other_info in globs.get(literal[:end], ()):
+                    if other not in group_conflicts[group] and _infos_may_intersect(info, other_info):
+                        group_conflicts[group].add(other)
+                        group_conflicts[other].add(group)
+    conflicts = [set() for _ in tasks]
+    for group, indexes in enumerate(groups):
+        related = set(unresolved)
+        for other in group_conflicts[group]:
+            related.update(groups[other])
+        for i in indexes:
+            conflicts[i] = related
+    if unresolved:
+        everything = set(range(len(tasks)))
+        for i in unresolved:
+            conflicts[i] = everything
+    # Sets are shared by the tasks with the same hosts and contain the task itself
+    return conflicts
+
+
+class Executor(object):
+    """
+    Runs tasks (deployment.Task) in parallel, at most 'workers' at the same time.
+    Tasks with intersecting hosts (or without hosts limit) never run at the same time
+    and start in the order of the list. Output of every playbook is prefixed by its name.
+    """
+
+    def __init__(self, config, workers, journal=None):
+        self._config = config
+        self.workers = workers
+        # journal.Journal: finished tasks are recorded, tasks completed in previous runs are skipped
+        self._journal = journal
+        # Exit codes of the tasks after run(), None for skipped tasks
+        self.results = []
+
+    def run(self, tasks, deps=None):
+        """
+        tasks: list of deployment.Task
+        deps: list of sets - indexes of tasks which must finish successfully before the task starts,
+              only previous tasks of the list. If any of them failed, the task is skipped.
+        If config['fail_fast'] is set, no tasks are started after the first failure.
+        Returns 0 if all tasks finished successfully, otherwise exit code of the first failed task
+        """
+        if deps is None:
+            deps = [set() for _ in tasks]
+        conflicts = _conflicts(tasks)
+        # Number of pending previous tasks with intersecting hosts, the task waits for them
+        blockers = [sum(1 for j in conflicts[i] if j < i) for i in range(len(tasks))]
+        pending = list(range(len(tasks)))
+        running = {}
+        finished = set()
+        results = [None] * len(tasks)
+
+        def leave_pending(i):
+            # Later conflicting tasks aren't blocked by the task anymore
+            for j in conflicts[i]:
+                if j > i:
+                    blockers[j] -= 1
+
+        if self._journal is not None:
+            for i in pending:
+                if self._journal.completed(tasks[i]):
+                    logger.info('Skip {}, finished in previous run'.format(tasks[i]['cmd']))
+                    leave_pending(i)
+                    finished.add(i)
+                    results[i] = 0
+            pending = [i for i in pending if i not in finished]
+        fail_fast = self._config.get('fail_fast')
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                if fail_fast and any(x not in (0, None) for x in results):
+                    for i in pending:
+                        logger.warning('Skip {}, fail fast'.format(tasks[i]['cmd']))
+                        finished.add(i)
+                    pending = []
+                still_pending = []
+                for i in pending:
+                    if any(j in finished and results[j] != 0 for j in deps[i]):
+                        logger.warning('Skip {}, previous task failed'.format(tasks[i]['cmd']))
+                        leave_pending(i)
+                        finished.add(i)
+                        continue
+                    if (len(running) >= self.workers or blockers[i] or not deps[i] <= finished
+                            or any(j in conflicts[i] for j in running.values())):
+                        still_pending.append(i)
+                        continue
+                    leave_pending(i)
+                    running[pool.submit(self._run_task, tasks[i])] = i
+                pending = still_pending
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = running.pop(future)
+                    results[i] = future.result()
+                    finished.add(i)
+        self.results = results
+        failed = [x for x in results if x != 0]
+        logger.info('Finished {} tasks, failed or skipped: {}'.format(len(tasks), len(failed)))
+        for code in failed:
+            if code is not None:
+                return code if code > 0 else 1
+        return 0
+
+    def _run_task(self, task):
+        shards = sharding.shard_task(task, self._config)
+        if shards:
+            # Shards have disjoint hosts and run at the same time
+            return Executor(self._config, len(shards), self._journal).run(shards)
+        if self._config['dry_run']:
+            logger.info('Dry run: {}'.format(task['cmd']))
+            return 0
+        prefix = '/'.join(task['playbook'].split('/')[-2:])
+        if task.play.get('shard'):
+            prefix = '{} {}'.format(prefix, task.play['shard'])
+        prefix = '[{}] '.format(prefix)
+        logger.info('Run {}'.format(task['cmd']))
+        started_at = time.time()
+        started = time.perf_counter()
+        proc = subprocess.Popen(
+            task['cmd'],
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=task.get_env(),
+        )
+        for line in proc.stdout:
+            line = line.decode('utf-8', errors='replace').rstrip('\n')
+            with _output_lock:
+                sys.stdout.write('{}{}\n'.format(prefix, line))
+                sys.stdout.flush()
+        proc.wait()
+        metrics.task_finished(task, time.perf_counter() - started, proc.returncode)
+        if self._journal is not None:
+            self._journal.record(task, started_at, time.time(), proc.returncode)
+        if proc.returncode != 0:
+            logger.error("Error! {}".format(task['cmd']))
+        return proc.returncode
@@ -0,0 +1,37 @@
+import logging
+import subprocess
+
+logger = logging.getLogger('git_source')
+
+
+class GitError(Exception):
+    pass
+
+
+def _git(root_dir, *args):
+    # Runs local git command in root_dir, returns list of NUL separated paths of the output
+    cmd = ['git', '-C', root_dir] + list(args)
+    try:
+        output = subprocess.check_output(cmd, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise GitError('Unable to run git: {}'.format(str(e)))
+    except subprocess.CalledProcessError as e:
+        raise GitError('{}: {}'.format(' '.join(cmd), e.stderr.decode('utf-8', errors='replace').strip()))
+    return [x for x in output.decode('utf-8', errors='surrogateescape').split('\0') if x]
+
+
+def tracked_files(root_dir):
+    """
+    Returns paths of the files from git index which are under root_dir, relative to root_dir.
+    Only the index is read: untracked and ignored files aren't listed and the tree isn't walked.
+    """
+    return _git(root_dir, 'ls-files', '-z', '--cached')
+
+
+def changed_files(root_dir, base):
+    """
+    base: str - commit (hash, branch, tag, HEAD~3, ...)
+    Returns paths of the tracked files under root_dir, relative to root_dir, which differ between
+    the base commit and the working tree (committed and uncommitted changes)
+    """
+    return _git(root_dir, 'diff', '--name-only', '-z', '--no-renames', '--relative', base, '--')
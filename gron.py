@@ -2,10 +2,15 @@
 import argparse
 import logger as logger_module
 import logging
-import discovery
-import pprint
+import metrics
+import output
+import atexit
 import sys
 import os
+# Modules with discovery and execution (yaml, deployment, ...) are imported when they are needed,
+# so --help, --show-tags and errors of arguments don't load them
+
+DEPLOYMENT_TASKS = ['_deploy_cert', '_certbot_acme','_certbot_upload','_gcore_upload']
 
 
 def parse_arguments():
@@ -20,14 +25,40 @@ def parse_arguments():
     parser.add_argument('-s','--show', action='store_true', help="Show all collected data")
     parser.add_argument('-sg','--show-dg', action='store_true', help="Show deployment groups with available tags")
     parser.add_argument('-st','--show-tags', action='store_true', help="Show available tags")
+    parser.add_argument('--format', dest='output_format', choices=output.FORMATS, help="Output format of --show and --show-dg, records are written as soon as they are produced")
+    parser.add_argument('--group-prefix', help="--show and --show-dg: only deployment groups which names start with the prefix (with -t - only this deployment task)")
     parser.add_argument('-g', '--deployment-group', help="Deployment group")
     parser.add_argument('-t','--deployment-task', help="Deployment task")
+    parser.add_argument('-G', '--deployment-groups', help="Comma separated deployment groups for pipeline mode")
+    parser.add_argument('--chain', help="Comma separated deployment tasks for pipeline mode, eg _certbot_acme,_certbot_upload,_deploy_cert")
+    parser.add_argument('--coalesce', action='store_true', help="Pipeline mode: run the same playbook for several groups once, variables of groups are passed in 'gron_deployment_groups'")
+    parser.add_argument('--batch', help="File with pairs 'deployment_group deployment_task' (one per line, '-' for stdin), all pairs are run after one discovery")
+    parser.add_argument('--batch-report', help="Write status of every pair of the batch to the file (JSON lines)")
     parser.add_argument('-C','--ansible-dry-run', action='store_true', help="ansible's '-C' flag for all playbooks")
     parser.add_argument('-D', '--ansible-debug', action='store_true', help="ansible's '-D' flag for all playbooks")
     parser.add_argument('-e', '--environment', action='append', help="Additional variables for ansible: -e \"a='b' c='d'\"")
     parser.add_argument('-l', '--limit', help="Limit execution by host (ansible-playbook -l)")
     parser.add_argument('--root-dir', help="Dir with playbooks, ~/ansible by default")
     parser.add_argument('--ansible-bin', help="Path to ansible-playbook bin, by default /usr/bin/ansible-playbook")
+    parser.add_argument('--git', action='store_true', help="Take files from git index of root dir instead of walking it (untracked and ignored files are skipped)")
+    parser.add_argument('--changed-since', help="Only playbooks which or which vars files changed since the git commit, eg --changed-since v1.2")
+    parser.add_argument('--index', dest='index_path', help="Path to discovery index, ~/.cache/gron/index.json by default")
+    parser.add_argument('--no-index', action='store_true', help="Don't use discovery index (parse all files)")
+    parser.add_argument('-j', '--jobs', type=int, help="Number of processes for parsing yaml files, -1 - number of CPUs (1 by default)")
+    parser.add_argument('-p', '--parallel', type=int, help="Number of playbooks running at the same time (1 by default)")
+    parser.add_argument('--shards', type=int, help="Split hosts of every playbook into N parts which run at the same time with disjoint '-l'")
+    parser.add_argument('--inventory', help="Local ansible inventory (INI or YAML) for resolving groups and patterns of hosts in --shards mode")
+    parser.add_argument('--plan-out', help="Save resolved deployment groups and commands to the plan file and exit")
+    parser.add_argument('--plan-in', help="Load deployment groups and commands from the plan file instead of discovery")
+    parser.add_argument('--serve', action='store_true', help="Run daemon which keeps deployment groups in memory")
+    parser.add_argument('--socket', dest='socket_path', help="Daemon's unix socket, ~/.cache/gron/gron.sock by default")
+    parser.add_argument('--no-daemon', action='store_true', help="Don't request deployment groups from daemon")
+    parser.add_argument('--resume', action='store_true', help="Skip playbooks which finished successfully in the previous run of the same groups and tasks")
+    parser.add_argument('--fail-fast', action='store_true', help="Don't start playbooks after the first failure")
+    parser.add_argument('--journal-dir', help="Dir with journals of runs, ~/.cache/gron/journal by default")
+    parser.add_argument('--profile', action='store_true', help="Show time of discovery phases, slowest files and playbook runs at exit")
+    parser.add_argument('--profile-top', type=int, help="Number of the slowest files in profile (10 by default)")
+    parser.add_argument('--metrics-out', help="Write metrics to the file at exit: prometheus text format for '*.prom', JSON otherwise")
     parser.add_argument('--dry-run', action='store_true', help="Dry run mode (without playbooks execution)")
     parser.add_argument('--debug', action='store_true', help="Debug")
     parser.add_argument('--silent', action='store_true', help="Show only critical logs")
@@ -41,10 +72,83 @@ def setup_logger(args):
         options['debug'] = True
     if args.silent:
         options['silent'] = True
+    if args.output_format:
+        options['stderr'] = True
     logger_module.setup(options=options)
     global logger
     logger = logging.getLogger('main')
 
+def validate_arguments(args):
+    # Returns error message or None, checked before any work with files
+    required_arguments = [
+        args.show,
+        args.show_dg,
+        args.show_tags,
+        args.deployment_group and args.deployment_task,
+        args.deployment_groups and args.chain,
+        args.plan_out,
+        args.serve,
+        args.batch,
+    ]
+    if not any(required_arguments):
+        return 'Required arguments not set'
+    if bool(args.deployment_groups) != bool(args.chain):
+        return 'Pipeline mode requires both deployment groups (-G) and chain (--chain)'
+    if args.plan_in and args.plan_out:
+        return '--plan-in and --plan-out can\'t be used together'
+    if args.plan_in and (args.ansible_dry_run or args.ansible_debug or args.limit or args.environment):
+        # Commands of the plan are run as saved, these flags would be ignored
+        return '-C, -D, -l and -e can\'t be used with --plan-in, set them with --plan-out'
+    if args.output_format and not (args.show or args.show_dg):
+        return '--format is used only with --show and --show-dg'
+    if args.batch_report and not args.batch:
+        return '--batch-report is used only with --batch'
+    return None
+
+
+# Config keys with integer values: (key, minimal value)
+INT_CONFIG_KEYS = (('jobs', None), ('parallel', 1), ('shards', 1), ('max_depth', 0),
+                   ('poll_interval', 1), ('vars_files_cache_size', 1), ('profile_top', 1))
+
+
+def validate_config(config):
+    # Returns error message or None
+    for key, minimum in INT_CONFIG_KEYS:
+        value = config.get(key)
+        if value is None:
+            continue
+        if not isinstance(value, int) or isinstance(value, bool):
+            return "Config: '{}' must be integer, got {!r}".format(key, value)
+        if minimum is not None and value < minimum:
+            return "Config: '{}' must be >= {}, got {}".format(key, minimum, value)
+        if key == 'jobs' and value == 0:
+            return "Config: 'jobs' must not be 0"
+    exclude = config.get('exclude')
+    if exclude is not None and not (isinstance(exclude, list) and all(isinstance(x, str) for x in exclude)):
+        return "Config: 'exclude' must be list of patterns"
+    for key in ('root_dir', 'ansible_bin', 'index_path', 'socket_path', 'journal_dir', 'inventory', 'metrics_out'):
+        if config.get(key) is not None and not isinstance(config[key], str):
+            return "Config: '{}' must be string, got {!r}".format(key, config[key])
+    return None
+
+
+def read_config(path):
+    # Returns config from the yaml file, exits on error
+    import yaml
+    try:
+        with open(path, 'r') as stream:
+            config = yaml.safe_load(stream)
+    except (OSError, yaml.YAMLError) as e:
+        logger.error('Unable to load config {}: {}'.format(path, str(e)))
+        sys.exit(1)
+    if config is None:
+        return {}
+    if not isinstance(config, dict):
+        logger.error('Config {} must be a mapping'.format(path))
+        sys.exit(1)
+    return config
+
+
 def load_config(args):
     config_path = None
     if not args.config and not args.no_config:
@@ -57,15 +161,23 @@ def load_config(args):
         config_path = args.config
     if config_path:
         logger.info('Config: {}'.format(config_path))
-        config = discovery.read_yaml(config_path)
+        config = read_config(config_path)
     else:
         config = {}
     for arg_key, arg_value in args.__dict__.items():
+        if (arg_value is None or arg_value is False) and config.get(arg_key) is not None:
+            # Keep value from config file if argument (or flag) not set
+            continue
         config[arg_key] = arg_value
-    config['deployment_tasks'] = ['_deploy_cert', '_certbot_acme','_certbot_upload','_gcore_upload']
+    config['deployment_tasks'] = list(DEPLOYMENT_TASKS)
     return config
 
 
+def show_tags(config):
+    # The same as DeploymentGroups.show_tags(), without discovery
+    return ''.join('- {}\n'.format(x) for x in config['deployment_tasks'] if x is not None)
+
+
 if __name__ == '__main__':
     args = parse_arguments()
     if args.environment:
@@ -78,32 +190,116 @@ if __name__ == '__main__':
         args.environment = tmp_env
     else:
         args.environment = []
+    error = validate_arguments(args)
+    if error:
+        print(error)
+        sys.exit(1)
     setup_logger(args)
     config = load_config(args)
-    required_arguments = [
-        args.show,
-        args.show_dg,
-        args.show_tags,
-        args.deployment_group and args.deployment_task
-    ]
-    if not any(required_arguments):
-        print('Required arguments not set')
+    error = validate_config(config)
+    if error:
+        logger.error(error)
         sys.exit(1)
-    deployment_groups = discovery.get_deployment_groups(config)
+    if config.get('profile') or config.get('metrics_out'):
+        metrics.enable()
+        atexit.register(metrics.report, config)
+    if args.serve:
+        import daemon
+        sys.exit(daemon.Daemon(config).serve())
+    if args.show_tags and not (args.show or args.show_dg or args.plan_out):
+        # Deployment tasks don't depend on playbooks
+        print('\n')
+        print(show_tags(config))
+        sys.exit(0)
+    import plan
+    import daemon
+    import journal
+    deployment_groups = None
+    pairs = None
+    if args.batch:
+        import batch
+        try:
+            pairs = batch.load_pairs(args.batch)
+        except (OSError, ValueError) as e:
+            logger.error('Unable to read batch {}: {}'.format(args.batch, str(e)))
+            sys.exit(1)
+    pipeline = args.deployment_groups and args.chain
+    # The plan contains all deployment groups, the same as --show
+    full_discovery = args.show or args.show_dg or args.show_tags or pipeline or args.plan_out
+    if args.plan_in:
+        with metrics.phase('plan'):
+            deployment_groups = plan.load_plan(args.plan_in, config)
+    elif not args.no_daemon:
+        groups = None
+        if pairs is not None:
+            groups = sorted(set(x[0] for x in pairs))
+        elif not full_discovery:
+            groups = [args.deployment_group]
+        with metrics.phase('daemon'):
+            deployment_groups = daemon.get_deployment_groups(config, groups)
+    if deployment_groups is None:
+        # yaml is needed only here, plans and replies of the daemon are loaded without it
+        import discovery
+        try:
+            if full_discovery or pairs is not None:
+                deployment_groups = discovery.get_deployment_groups(config)
+            else:
+                deployment_groups = discovery.get_deployment_groups(config,
+                                                                    group=args.deployment_group,
+                                                                    task=args.deployment_task)
+        except discovery.DiscoveryError:
+            # The error is already logged
+            if config.get('debug'):
+                raise
+            sys.exit(1)
+    if args.plan_out:
+        plan.save_plan(deployment_groups, args.plan_out)
+        sys.exit(0)
+    if (args.show or args.show_dg) and (args.group_prefix or args.deployment_task):
+        deployment_groups = deployment_groups.filter(args.group_prefix, args.deployment_task)
+    if (args.show or args.show_dg) and args.output_format:
+        fields = output.SHOW_FIELDS if args.show else output.SHOW_DG_FIELDS
+        with metrics.phase('output'):
+            output.write_records(output.iter_records(deployment_groups, fields), args.output_format, sys.stdout)
+        sys.exit(0)
     if args.show:
         print('\n')
-        print(deployment_groups)
+        with metrics.phase('output'):
+            print(deployment_groups)
         sys.exit(0)
     if args.show_dg:
         print('\n')
-        print(deployment_groups.show_dg())
+        with metrics.phase('output'):
+            print(deployment_groups.show_dg())
         sys.exit(0)
     if args.show_tags:
         print('\n')
         print(deployment_groups.show_tags())
         sys.exit(0)
+    if pipeline:
+        groups = [x.strip() for x in args.deployment_groups.split(',') if x.strip()]
+        chain = [x.strip() for x in args.chain.split(',') if x.strip()]
+        run_journal = None
+        if not config['dry_run']:
+            run_journal = journal.Journal.open(config, deployment_groups, groups, chain)
+        with metrics.phase('run'):
+            exit_code = deployment_groups.run_pipeline(groups, chain, run_journal)
+        sys.exit(exit_code)
+    if pairs is not None:
+        with metrics.phase('run'):
+            reports = batch.run_batch(deployment_groups, pairs, config)
+        if args.batch_report:
+            batch.write_reports(reports, args.batch_report)
+        logger.info('Batch report:\n{}'.format(batch.format_reports(reports)))
+        sys.exit(batch.batch_exit_code(reports))
     if not args.deployment_group and not args.deployment_task:
         print('deployment group (-g) and deployment task (-t) is required')
         sys.exit(1)
-    deployment_groups.run(args.deployment_group, args.deployment_task)
+    run_journal = None
+    if not config['dry_run']:
+        run_journal = journal.Journal.open(config, deployment_groups,
+                                           [args.deployment_group], [args.deployment_task])
+    with metrics.phase('run'):
+        exit_code = deployment_groups.run(args.deployment_group, args.deployment_task, run_journal)
+    sys.exit(exit_code)
 
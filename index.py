@@ -0,0 +1,127 @@
+import json
+import logging
+import os
+
+logger = logging.getLogger('index')
+
+INDEX_VERSION = 3
+DEFAULT_INDEX_PATH = '~/.cache/gron/index.json'
+
+
+def file_signature(path):
+    # (mtime, size, inode) of the file or None if file doesn't exist
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+
+class DiscoveryIndex(object):
+    """
+    Persistent on-disk cache of parsed playbooks.
+    Stores the output of _parse_hosts_vars() (discovery.py) for every play of the file
+    and the warnings logged while parsing it, they are logged again on hit:
+    {
+        'version': 3,
+        'config': <fingerprint of the config keys used by _parse_hosts_vars>,
+        'files': {
+            '/home/user/ansible/nginx/nginx.yml': {
+                'signature': [mtime_ns, size, inode],
+                'deps': {'/home/user/ansible/vars/gron.yml': [mtime_ns, size, inode]},
+                'plays': [{'<deployment_task>': {'play': {...}, 'deployment_groups': [{'dg': ..., ...}]}}, ...],
+                'warnings': [[30, 'Metadata format is invalid. ...'], ...]
+            }, ...
+        }
+    }
+    The entry is valid only if the file and all vars_files it depends on are unchanged.
+    """
+
+    def __init__(self, path, config):
+        self.path = os.path.expanduser(path)
+        self._config_fingerprint = self._make_config_fingerprint(config)
+        self._files = {}
+        self._changed = False
+        # Files looked up with get(), entries of other files are dropped by save()
+        self._seen = set()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _make_config_fingerprint(config):
+        return {
+            'deployment_tasks': list(config['deployment_tasks']),
+            'limit': config.get('limit'),
+        }
+
+    @classmethod
+    def load(cls, config):
+        path = config.get('index_path') or DEFAULT_INDEX_PATH
+        index = cls(path, config)
+        if not os.path.exists(index.path):
+            logger.debug('Index {} not found, will be created'.format(index.path))
+            return index
+        try:
+            with open(index.path, 'r') as stream:
+                data = json.load(stream)
+        except (OSError, ValueError) as e:
+            logger.warning('Index {} is broken, ignored: {}'.format(index.path, str(e)))
+            return index
+        if data.get('version') != INDEX_VERSION:
+            logger.debug('Index {} has another version, ignored'.format(index.path))
+            return index
+        if data.get('config') != index._config_fingerprint:
+            logger.debug('Index {} was built with another config, ignored'.format(index.path))
+            return index
+        index._files = data.get('files', {})
+        return index
+
+    def get(self, path):
+        # Returns cached (plays, vars_files, warnings) of the file or None if file is new or changed
+        self._seen.add(path)
+        entry = self._files.get(path)
+        if entry is None or entry['signature'] != file_signature(path):
+            self.misses += 1
+            return None
+        for dep_path, dep_signature in entry['deps'].items():
+            if dep_signature != file_signature(dep_path):
+                self.misses += 1
+                return None
+        self.hits += 1
+        return entry['plays'], list(entry['deps']), entry['warnings']
+
+    def put(self, path, plays, vars_files, warnings):
+        self._files[path] = {
+            'signature': file_signature(path),
+            'deps': {x: file_signature(x) for x in vars_files},
+            'plays': plays,
+            'warnings': warnings,
+        }
+        self._changed = True
+
+    def save(self):
+        """
+        Drops entries of the files that weren't looked up with get() and writes the index atomically
+        """
+        for path in list(self._files):
+            if path not in self._seen:
+                del self._files[path]
+                self._changed = True
+        logger.debug('Index hits: {}, misses: {}'.format(self.hits, self.misses))
+        if not self._changed:
+            return
+        data = {
+            'version': INDEX_VERSION,
+            'config': self._config_fingerprint,
+            'files': self._files,
+        }
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as stream:
+                json.dump(data, stream, default=str)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning('Unable to save index {}: {}'.format(self.path, str(e)))
+            return
+        self._changed = False
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from plan import file_digest, sources_fingerprint
+
+logger = logging.getLogger('journal')
+
+DEFAULT_JOURNAL_DIR = '~/.cache/gron/journal'
+
+
+def run_key(groups, tasks):
+    # Name of the journal: the same groups with the same deployment tasks share the journal
+    return '{}:{}'.format(','.join(groups), ','.join(tasks))
+
+
+class Journal(object):
+    """
+    Journal of the run: one JSON line for every finished ansible-playbook run
+        {'dg': ..., 'playbook': ..., 'hosts': ..., 'cmd': <sha256 of the command>,
+         'sources': <sha256 of the playbook and its vars files>, 'started': ..., 'finished': ..., 'exit_code': 0}
+    A new run truncates the journal of the same groups and tasks, the resumed run (--resume)
+    skips tasks which finished successfully with the same command and source files and appends to it.
+    """
+
+    def __init__(self, path, key, sources, resume=False):
+        """
+        path: str - journal file
+        key: str - run_key() of the run
+        sources: dict - {playbook: [vars_files]} (DeploymentGroups.sources)
+        """
+        self.path = path
+        self.key = key
+        self._sources = sources
+        self._digests = {}
+        self._completed = set()
+        self._lock = threading.Lock()
+        if resume:
+            self._load()
+        else:
+            self._write({'run': key, 'started': time.time()}, mode='w')
+
+    @classmethod
+    def open(cls, config, deployment_groups, groups, tasks):
+        journal_dir = os.path.expanduser(config.get('journal_dir') or DEFAULT_JOURNAL_DIR)
+        key = run_key(groups, tasks)
+        name = '{}.jsonl'.format(hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+        path = os.path.join(journal_dir, name)
+        logger.debug('Journal: {}'.format(path))
+        return cls(path, key, deployment_groups.sources, resume=config.get('resume'))
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as stream:
+                lines = stream.readlines()
+        except OSError:
+            logger.info('Journal {} not found, nothing to resume'.format(self.path))
+            self._write({'run': self.key, 'started': time.time()}, mode='w')
+            return
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line is broken if gron was killed while writing it
+                continue
+            if entry.get('run') is not None and entry['run'] != self.key:
+                logger.warning('Journal {} belongs to another run, ignored'.format(self.path))
+                self._completed = set()
+                return
+            if entry.get('exit_code') == 0:
+                self._completed.add((entry['cmd'], entry['sources']))
+        logger.info('Resume: {} tasks finished successfully in previous runs'.format(len(self._completed)))
+
+    def _write(self, entry, mode='a'):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with self._lock, open(self.path, mode) as stream:
+                stream.write(json.dumps(entry) + '\n')
+        except OSError as e:
+            logger.warning('Unable to write journal {}: {}'.format(self.path, str(e)))
+
+    def _fingerprints(self, task):
+        cmd = hashlib.sha256(task['cmd'].encode('utf-8')).hexdigest()
+        playbook = task['playbook']
+        digests = {}
+        for path in [playbook] + list(self._sources.get(playbook, [])):
+            if path not in self._digests:
+                self._digests[path] = file_digest(path)
+            digests[path] = self._digests[path]
+        return cmd, sources_fingerprint(digests)
+
+    def completed(self, task):
+        # True if the task finished successfully with the same command and source files
+        return self._fingerprints(task) in self._completed
+
+    def record(self, task, started, finished, exit_code):
+        cmd, sources = self._fingerprints(task)
+        self._write({
+            'dg': task.get('dg'),
+            'playbook': task['playbook'],
+            'hosts': task.get('hosts'),
+            'cmd': cmd,
+            'sources': sources,
+            'started': started,
+            'finished': finished,
+            'exit_code': exit_code,
+        })
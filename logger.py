@@ -1,5 +1,4 @@
 import logging
-import logging.handlers
 import os
 import sys
 
@@ -17,8 +16,9 @@ class LevelFilter(logging.Filter):
 
 def setup(options):
     # options must be options = {'debug': False, 'silent': False}
+    # 'stderr': True - all logs are written to stderr (stdout is used for machine readable output)
     fr = "%(message)s"
-    stdout_handler = logging.StreamHandler(sys.stdout)
+    stdout_handler = logging.StreamHandler(sys.stderr if options.get('stderr') else sys.stdout)
     if options.get('debug'):
         stdout_filter = LevelFilter(logging.DEBUG, logging.CRITICAL) 
     else:
@@ -0,0 +1,220 @@
+import collections
+import contextlib
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+logger = logging.getLogger('metrics')
+
+DEFAULT_PROFILE_TOP = 10
+# Prefix of prometheus metrics
+PROMETHEUS_PREFIX = 'gron'
+
+# Recorder of the current process, None if metrics are disabled.
+# Hooks below do nothing in this case, so disabled metrics cost only a check of this variable.
+_metrics = None
+_null_context = contextlib.nullcontext()
+
+
+def _cpu_time():
+    # CPU time of the process and its finished children (parsing workers, ansible-playbook)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def _max_rss_bytes(who):
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    max_rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss
+    return max_rss * 1024
+
+
+class Metrics(object):
+    """
+    Instrumentation of one gron run:
+        phases - wall and CPU time of discovery phases, output and execution
+        files - parse time of every parsed file
+        tasks - duration and exit code of every ansible-playbook run
+        counts - numbers of files, deployment groups, tasks and discovery counters
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._started_wall = time.perf_counter()
+        self.phases = collections.OrderedDict()
+        self.files = []
+        self.tasks = []
+        self.counts = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        # Time of the phase is added to the previous time of the phase with the same name
+        wall = time.perf_counter()
+        cpu = _cpu_time()
+        try:
+            yield
+        finally:
+            entry = self.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+            entry['wall'] += time.perf_counter() - wall
+            entry['cpu'] += _cpu_time() - cpu
+
+    def to_dict(self, top=DEFAULT_PROFILE_TOP):
+        slowest = sorted(self.files, key=lambda x: x[1], reverse=True)[:top]
+        return {
+            'started': self.started,
+            'duration': time.perf_counter() - self._started_wall,
+            'phases': self.phases,
+            'counts': self.counts,
+            'files_parse_seconds': sum(x[1] for x in self.files),
+            'slowest_files': [{'path': path, 'seconds': seconds} for path, seconds in slowest],
+            'tasks': self.tasks,
+            'peak_rss_bytes': _max_rss_bytes(resource.RUSAGE_SELF),
+            'children_peak_rss_bytes': _max_rss_bytes(resource.RUSAGE_CHILDREN),
+        }
+
+    def summary(self, top=DEFAULT_PROFILE_TOP):
+        data = self.to_dict(top)
+        lines = ['Profile: {:.3f}s'.format(data['duration'])]
+        lines.append('  {:<20} {:>10} {:>10}'.format('phase', 'wall', 'cpu'))
+        for name, entry in data['phases'].items():
+            lines.append('  {:<20} {:>9.3f}s {:>9.3f}s'.format(name, entry['wall'], entry['cpu']))
+        if data['counts']:
+            lines.append('Counts:')
+            for name, value in data['counts'].items():
+                lines.append('  {}: {}'.format(name, value))
+        if data['slowest_files']:
+            lines.append('Slowest files (total parse time {:.3f}s):'.format(data['files_parse_seconds']))
+            for entry in data['slowest_files']:
+                lines.append('  {:.4f}s {}'.format(entry['seconds'], entry['path']))
+        if data['tasks']:
+            lines.append('Tasks:')
+            for entry in data['tasks']:
+                lines.append('  {:.3f}s exit {} {} {}'.format(
+                    entry['duration'], entry['exit_code'], entry['dg'], entry['playbook']))
+        lines.append('Peak RSS: {:.1f} MB, children: {:.1f} MB'.format(
+            data['peak_rss_bytes'] / 1048576, data['children_peak_rss_bytes'] / 1048576))
+        return '\n'.join(lines)
+
+    def to_prometheus(self, top=DEFAULT_PROFILE_TOP):
+        # Text format for node exporter's textfile collector
+        data = self.to_dict(top)
+        metrics = collections.OrderedDict()
+
+        def add(metric, help_text, value, **labels):
+            metric = '{}_{}'.format(PROMETHEUS_PREFIX, metric)
+            if metric not in metrics:
+                metrics[metric] = (help_text, [])
+            labels = ','.join('{}="{}"'.format(key, _escape_label(label)) for key, label in labels.items())
+            metrics[metric][1].append('{}{} {}'.format(metric, '{' + labels + '}' if labels else '', value))
+
+        add('last_run_timestamp_seconds', 'Start time of the last run', data['started'])
+        add('duration_seconds', 'Wall time of the run', data['duration'])
+        for phase, entry in data['phases'].items():
+            add('phase_wall_seconds', 'Wall time of the phase', entry['wall'], phase=phase)
+            add('phase_cpu_seconds', 'CPU time of the phase (with child processes)', entry['cpu'], phase=phase)
+        for name, value in data['counts'].items():
+            add('count', 'Numbers of files, deployment groups and tasks', value, name=name)
+        add('files_parse_seconds', 'Total parse time of files', data['files_parse_seconds'])
+        for entry in data['slowest_files']:
+            add('file_parse_seconds', 'Parse time of the slowest files', entry['seconds'], path=entry['path'])
+        for entry in data['tasks']:
+            labels = {'dg': entry['dg'], 'playbook': entry['playbook'], 'hosts': entry['hosts'] or ''}
+            add('task_duration_seconds', 'Duration of ansible-playbook run', entry['duration'], **labels)
+            add('task_exit_code', 'Exit code of ansible-playbook run', entry['exit_code'], **labels)
+        add('peak_rss_bytes', 'Peak RSS of gron process', data['peak_rss_bytes'])
+        add('children_peak_rss_bytes', 'Peak RSS of child processes', data['children_peak_rss_bytes'])
+        lines = []
+        for name, (help_text, samples) in metrics.items():
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, top=DEFAULT_PROFILE_TOP):
+        # Prometheus text format for '*.prom' files, JSON otherwise. Written atomically
+        if path.endswith('.prom'):
+            output = self.to_prometheus(top)
+        else:
+            output = json.dumps(self.to_dict(top), indent=2)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as stream:
+                stream.write(output)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning('Unable to write metrics {}: {}'.format(path, str(e)))
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def enable():
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def enabled():
+    return _metrics is not None
+
+
+def get():
+    return _metrics
+
+
+def phase(name):
+    # Context manager which records the time of the phase
+    if _metrics is None:
+        return _null_context
+    return _metrics.phase(name)
+
+
+def add_phase_time(name, wall, cpu):
+    # Adds time measured outside of phase() (e.g. in other processes) to the phase
+    if _metrics is not None:
+        entry = _metrics.phases.setdefault(name, {'wall': 0.0, 'cpu': 0.0})
+        entry['wall'] += wall
+        entry['cpu'] += cpu
+
+
+def file_parsed(path, seconds):
+    if _metrics is not None:
+        _metrics.files.append((path, seconds))
+
+
+def task_finished(task, seconds, returncode):
+    if _metrics is not None:
+        _metrics.tasks.append({
+            'dg': task.get('dg'),
+            'playbook': task['playbook'],
+            'hosts': task.get('hosts'),
+            'duration': seconds,
+            'exit_code': returncode,
+        })
+
+
+def peak_rss_bytes():
+    # Peak RSS of the current process, available even if metrics are disabled
+    return _max_rss_bytes(resource.RUSAGE_SELF)
+
+
+def update_counts(counts):
+    if _metrics is not None:
+        _metrics.counts.update(counts)
+
+
+def report(config):
+    # Prints summary (--profile) and writes metrics file (--metrics-out), called at exit
+    if _metrics is None:
+        return
+    top = config.get('profile_top') or DEFAULT_PROFILE_TOP
+    if config.get('metrics_out'):
+        _metrics.write(config['metrics_out'], top)
+    if config.get('profile'):
+        sys.stderr.write(_metrics.summary(top) + '\n')
@@ -0,0 +1,60 @@
+import json
+
+FORMATS = ('json', 'ndjson', 'yaml')
+# Fields of the records, the order is stable
+SHOW_FIELDS = ('group', 'task', 'playbook', 'hosts', 'tags', 'args', 'vars', 'cmd')
+SHOW_DG_FIELDS = ('group', 'task', 'playbook')
+
+
+def iter_records(deployment_groups, fields=SHOW_FIELDS):
+    """
+    Generator, yields one record for every playbook of every deployment task of every group:
+        {'group': 'domain.ru_year', 'task': '_deploy_cert', 'playbook': '/home/user/ansible/nginx/nginx.yml',
+         'hosts': 'host-*.domain.ru', 'tags': ['certs'], 'args': [...], 'vars': {'dg': ...}, 'cmd': '...'}
+    Only 'fields' are filled, so commands aren't built for --show-dg.
+    """
+    for group, dtasks in deployment_groups.items():
+        for task_name, tasks in dtasks.items():
+            for task in tasks:
+                record = {}
+                for field in fields:
+                    if field == 'group':
+                        record[field] = group
+                    elif field == 'task':
+                        record[field] = task_name
+                    elif field == 'vars':
+                        record[field] = task.extra_vars()
+                    else:
+                        record[field] = task.get(field)
+                yield record
+
+
+def write_records(records, output_format, stream):
+    """
+    Writes records to the stream as soon as they are produced:
+        json - list of objects, ndjson - one object per line, yaml - list of mappings
+    """
+    if output_format == 'ndjson':
+        for record in records:
+            stream.write(json.dumps(record, default=str) + '\n')
+    elif output_format == 'json':
+        stream.write('[')
+        separator = '\n'
+        for record in records:
+            stream.write(separator + json.dumps(record, default=str))
+            separator = ',\n'
+        stream.write('\n]\n')
+    elif output_format == 'yaml':
+        # yaml is imported only for this format, gron.py imports this module at startup
+        import yaml
+        Dumper = getattr(yaml, 'CDumper', yaml.Dumper)
+        empty = True
+        for record in records:
+            # Every record is an item of the list, so the output is one yaml document
+            stream.write(yaml.dump([json.loads(json.dumps(record, default=str))], Dumper=Dumper, sort_keys=False))
+            empty = False
+        if empty:
+            stream.write('[]\n')
+    else:
+        raise ValueError('Unknown format {}'.format(output_format))
+    stream.flush()
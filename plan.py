@@ -0,0 +1,105 @@
+import hashlib
+import json
+import logging
+import sys
+import time
+from deployment import DeploymentGroups, Task, json_default
+
+logger = logging.getLogger('plan')
+
+PLAN_VERSION = 1
+
+
+def file_digest(path):
+    # sha256 of the file content or None if file doesn't exist
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as stream:
+            for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def sources_fingerprint(sources):
+    # sources: {path: sha256}, returns one sha256 for all files
+    digest = hashlib.sha256()
+    for path in sorted(sources):
+        digest.update('{}\0{}\0'.format(path, sources[path]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def save_plan(deployment_groups, path):
+    """
+    Writes fully resolved deployment groups to the plan file:
+    {
+        'version': 1,
+        'created': <timestamp>,
+        'fingerprint': <sha256 of all source files>,
+        'sources': {'/home/user/ansible/nginx/nginx.yml': <sha256>, ...},
+        'vars_files': {'/home/user/ansible/nginx/nginx.yml': ['/home/user/ansible/vars/gron.yml'], ...},
+        'groups': {'domain.ru_year': {'_deploy_cert': [{'dg': ..., 'cmd': ..., ...}, ...]}, ...}
+    }
+    Exits if there are no deployment groups.
+    """
+    if not deployment_groups:
+        logger.error('No deployment groups found, plan {} is not saved'.format(path))
+        sys.exit(1)
+    vars_files = {}
+    for dtasks in deployment_groups.values():
+        for tasks in dtasks.values():
+            for task in tasks:
+                playbook = task['playbook']
+                vars_files[playbook] = deployment_groups.sources.get(playbook, [])
+    sources = {}
+    for playbook, playbook_vars_files in vars_files.items():
+        for source in [playbook] + playbook_vars_files:
+            if source not in sources:
+                sources[source] = file_digest(source)
+    data = {
+        'version': PLAN_VERSION,
+        'created': int(time.time()),
+        'fingerprint': sources_fingerprint(sources),
+        'sources': sources,
+        'vars_files': vars_files,
+        'groups': deployment_groups,
+    }
+    with open(path, 'w') as stream:
+        json.dump(data, stream, separators=(',', ':'), default=json_default)
+    logger.info('Plan saved to {}: {} groups, {} source files'.format(
+        path, len(deployment_groups), len(sources)))
+
+
+def load_plan(path, config):
+    """
+    Loads deployment groups from the plan file without discovery.
+    Exits if the plan is stale (source files changed since it was created).
+    """
+    logger.info('Plan: {}'.format(path))
+    try:
+        with open(path, 'r') as stream:
+            data = json.load(stream)
+    except (OSError, ValueError) as e:
+        logger.error('Unable to load plan {}: {}'.format(path, str(e)))
+        sys.exit(1)
+    if data.get('version') != PLAN_VERSION:
+        logger.error('Plan {} has unsupported version {}'.format(path, data.get('version')))
+        sys.exit(1)
+    changed = [x for x, digest in data['sources'].items() if file_digest(x) != digest]
+    if changed:
+        for source in changed:
+            logger.error('Plan is stale, file changed: {}'.format(source))
+        sys.exit(1)
+    logger.debug('Plan fingerprint: {}'.format(data['fingerprint']))
+    return deployment_groups_from_data(data['groups'], data['vars_files'], config)
+
+
+def deployment_groups_from_data(groups, vars_files, config):
+    # Creates DeploymentGroups from serialized groups with ready commands (plan file, daemon)
+    for dtasks in groups.values():
+        for task_name, tasks in dtasks.items():
+            dtasks[task_name] = [Task.from_dict(task, config) for task in tasks]
+    deployment_groups = DeploymentGroups({}, config, vars_files)
+    deployment_groups.update(groups)
+    return deployment_groups
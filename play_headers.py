@@ -0,0 +1,149 @@
+import logging
+import yaml
+from yaml.events import (AliasEvent, ScalarEvent, SequenceStartEvent, SequenceEndEvent,
+                         MappingStartEvent, MappingEndEvent, StreamEndEvent, CollectionStartEvent,
+                         CollectionEndEvent)
+from yaml.nodes import ScalarNode, SequenceNode, MappingNode
+
+logger = logging.getLogger('play_headers')
+
+# Play keys which are used by discovery
+PLAY_KEYS = ('hosts', 'vars', 'vars_files')
+
+STR_TAG = 'tag:yaml.org,2002:str'
+MERGE_TAG = 'tag:yaml.org,2002:merge'
+
+
+class FallbackRequired(Exception):
+    pass
+
+
+def load_play_headers(file_src, loader_class):
+    """
+    Loads playbook, but constructs only PLAY_KEYS of each play:
+    tasks, handlers, roles, etc. are parsed as events and dropped without building nodes and objects.
+    Returns the same data as yaml.load for PLAY_KEYS, other keys of plays are missing.
+    Falls back to yaml.load if the document can't be loaded partially
+    (it isn't a list of plays, aliases to skipped data, merge keys in plays, etc.)
+    """
+    try:
+        return _load_play_headers(file_src, loader_class)
+    except FallbackRequired as e:
+        logger.debug('Full load is required: {}'.format(str(e)))
+        return yaml.load(file_src, Loader=loader_class)
+
+
+def _load_play_headers(file_src, loader_class):
+    loader = loader_class(file_src)
+    try:
+        loader.get_event()  # StreamStartEvent
+        if loader.check_event(StreamEndEvent):
+            return None
+        loader.get_event()  # DocumentStartEvent
+        if not loader.check_event(SequenceStartEvent):
+            raise FallbackRequired('document is not a list')
+        composer = _HeadersComposer(loader)
+        node = composer.compose_plays()
+        loader.get_event()  # DocumentEndEvent
+        if not loader.check_event(StreamEndEvent):
+            raise FallbackRequired('several documents in the stream')
+        return loader.construct_document(node)
+    finally:
+        loader.dispose()
+
+
+class _HeadersComposer(object):
+    # Builds nodes from parser events, like yaml.composer.Composer
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.anchors = {}
+
+    def compose_plays(self):
+        start_event = self.loader.get_event()
+        if start_event.anchor is not None:
+            raise FallbackRequired('anchor on the list of plays')
+        node = SequenceNode(self._resolve(SequenceNode, None, start_event.tag, start_event.implicit),
+                            [], start_event.start_mark, None, flow_style=start_event.flow_style)
+        while not self.loader.check_event(SequenceEndEvent):
+            if self.loader.check_event(MappingStartEvent):
+                node.value.append(self.compose_play())
+            else:
+                # Not a play, discovery skips it
+                self.skip_node()
+                node.value.append(ScalarNode('tag:yaml.org,2002:null', ''))
+        end_event = self.loader.get_event()
+        node.end_mark = end_event.end_mark
+        return node
+
+    def compose_play(self):
+        start_event = self.loader.get_event()
+        if start_event.anchor is not None:
+            raise FallbackRequired('anchor on the play')
+        node = MappingNode(self._resolve(MappingNode, None, start_event.tag, start_event.implicit),
+                           [], start_event.start_mark, None, flow_style=start_event.flow_style)
+        while not self.loader.check_event(MappingEndEvent):
+            key_node = self.compose_node()
+            if key_node.tag == MERGE_TAG:
+                raise FallbackRequired('merge key in the play')
+            if key_node.tag == STR_TAG and key_node.value in PLAY_KEYS:
+                node.value.append((key_node, self.compose_node()))
+            else:
+                self.skip_node()
+        end_event = self.loader.get_event()
+        node.end_mark = end_event.end_mark
+        return node
+
+    def compose_node(self):
+        if self.loader.check_event(AliasEvent):
+            event = self.loader.get_event()
+            if event.anchor not in self.anchors:
+                raise FallbackRequired("alias '{}' to skipped or undefined anchor".format(event.anchor))
+            return self.anchors[event.anchor]
+        event = self.loader.get_event()
+        anchor = event.anchor
+        if isinstance(event, ScalarEvent):
+            node = ScalarNode(self._resolve(ScalarNode, event.value, event.tag, event.implicit),
+                              event.value, event.start_mark, event.end_mark, style=event.style)
+        elif isinstance(event, SequenceStartEvent):
+            node = SequenceNode(self._resolve(SequenceNode, None, event.tag, event.implicit),
+                                [], event.start_mark, None, flow_style=event.flow_style)
+            if anchor is not None:
+                self.anchors[anchor] = node
+            while not self.loader.check_event(SequenceEndEvent):
+                node.value.append(self.compose_node())
+            node.end_mark = self.loader.get_event().end_mark
+        else:
+            node = MappingNode(self._resolve(MappingNode, None, event.tag, event.implicit),
+                               [], event.start_mark, None, flow_style=event.flow_style)
+            if anchor is not None:
+                self.anchors[anchor] = node
+            while not self.loader.check_event(MappingEndEvent):
+                item_key = self.compose_node()
+                item_value = self.compose_node()
+                node.value.append((item_key, item_value))
+            node.end_mark = self.loader.get_event().end_mark
+        if anchor is not None:
+            self.anchors[anchor] = node
+        return node
+
+    def skip_node(self):
+        # Drops events of the node, anchors defined inside it can't be used anymore
+        depth = 0
+        while True:
+            event = self.loader.get_event()
+            if getattr(event, 'anchor', None) is not None and not isinstance(event, AliasEvent):
+                self.anchors.pop(event.anchor, None)
+            if isinstance(event, CollectionStartEvent):
+                depth += 1
+            elif isinstance(event, CollectionEndEvent):
+                depth -= 1
+            if depth == 0:
+                return
+
+    def _resolve(self, kind, value, tag, implicit):
+        if tag is None or tag == '!':
+            if kind is ScalarNode:
+                return self.loader.resolve(kind, value, implicit)
+            return self.loader.resolve(kind, None, implicit)
+        return tag
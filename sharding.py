@@ -0,0 +1,241 @@
+import fnmatch
+import logging
+import os
+import re
+import string
+
+logger = logging.getLogger('sharding')
+
+WILDCARDS = ('*', '?', '[')
+# web[01:10].domain.ru, db-[a:c].domain.ru
+_RANGE_RE = re.compile(r'\[([0-9a-zA-Z]+):([0-9a-zA-Z]+)(?::([0-9]+))?\]')
+
+
+class Inventory(object):
+    """
+    Hosts and groups of the local ansible inventory file (INI or YAML).
+    Only names are loaded, variables are ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # {group: [hosts]}, {group: [child groups]}
+        self.groups = {'all': [], 'ungrouped': []}
+        self.children = {}
+        self.hosts = []
+        self._hosts_set = set()
+
+    @classmethod
+    def load(cls, path):
+        inventory = cls(path)
+        with open(path, 'r') as stream:
+            src = stream.read()
+        if path.endswith(('.yml', '.yaml', '.json')):
+            import yaml
+            Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+            inventory._load_yaml(yaml.load(src, Loader=Loader) or {})
+        else:
+            inventory._load_ini(src)
+        logger.debug('Inventory {}: {} hosts, {} groups'.format(path, len(inventory.hosts), len(inventory.groups)))
+        return inventory
+
+    def _add_host(self, group, pattern):
+        for host in expand_host_range(pattern):
+            if host not in self._hosts_set:
+                self._hosts_set.add(host)
+                self.hosts.append(host)
+            self.groups.setdefault(group, []).append(host)
+
+    def _load_ini(self, src):
+        group = 'ungrouped'
+        kind = 'hosts'
+        for line in src.splitlines():
+            line = line.strip()
+            if not line or line.startswith(('#', ';')):
+                continue
+            if line.startswith('['):
+                name = line.strip('[]')
+                group, _, kind = name.partition(':')
+                kind = kind or 'hosts'
+                self.groups.setdefault(group, [])
+                continue
+            if kind == 'hosts':
+                self._add_host(group, line.split()[0])
+            elif kind == 'children':
+                self.children.setdefault(group, []).append(line.split()[0])
+
+    def _load_yaml(self, data):
+        for group, group_data in data.items():
+            self._load_yaml_group(group, group_data or {})
+
+    def _load_yaml_group(self, group, data):
+        self.groups.setdefault(group, [])
+        for host in (data.get('hosts') or {}):
+            self._add_host(group, host)
+        for child, child_data in (data.get('children') or {}).items():
+            self.children.setdefault(group, []).append(child)
+            self._load_yaml_group(child, child_data or {})
+
+    def group_hosts(self, group, seen=None):
+        # Hosts of the group and its children
+        if group == 'all':
+            return list(self.hosts)
+        if seen is None:
+            seen = set()
+        seen.add(group)
+        result = list(self.groups.get(group, []))
+        for child in self.children.get(group, []):
+            if child not in seen:
+                result.extend(self.group_hosts(child, seen))
+        return result
+
+
+def expand_host_range(pattern):
+    # 'web[01:03].domain.ru' -> ['web01.domain.ru', 'web02.domain.ru', 'web03.domain.ru']
+    match = _RANGE_RE.search(pattern)
+    if match is None:
+        return [pattern]
+    start, end, step = match.group(1), match.group(2), int(match.group(3) or 1)
+    if start.isdigit() and end.isdigit():
+        width = len(start) if start.startswith('0') else 0
+        values = ['{:0{}d}'.format(x, width) for x in range(int(start), int(end) + 1, step)]
+    else:
+        letters = string.ascii_letters
+        values = list(letters[letters.index(start):letters.index(end) + 1:step])
+    result = []
+    for value in values:
+        result.extend(expand_host_range(pattern[:match.start()] + value + pattern[match.end():]))
+    return result
+
+
+_inventories = {}
+
+
+def load_inventory(path):
+    # Inventory is loaded once per process
+    path = os.path.expanduser(path)
+    if path not in _inventories:
+        _inventories[path] = Inventory.load(path)
+    return _inventories[path]
+
+
+# Kinds of the terms of ansible hosts patterns
+TERM_ALL = 'all'
+TERM_GROUP = 'group'
+TERM_REGEXP = 'regexp'
+TERM_GLOB = 'glob'
+TERM_HOST = 'host'
+
+
+def term_kind(term, inventory=None):
+    """
+    term: str - one term of ansible hosts pattern without '!' and '&' ('web-*.domain.ru')
+    inventory: Inventory | None - without inventory names without '.' (except localhost) are taken as groups
+    Returns kind of the term: TERM_ALL, TERM_GROUP, TERM_REGEXP, TERM_GLOB or TERM_HOST
+    """
+    if term in ('all', '*'):
+        return TERM_ALL
+    if term[0] == '~':
+        return TERM_REGEXP
+    if inventory is None:
+        if '.' not in term and term != 'localhost':
+            return TERM_GROUP
+    elif term in inventory.groups:
+        return TERM_GROUP
+    if any(x in term for x in WILDCARDS):
+        return TERM_GLOB
+    return TERM_HOST
+
+
+def _resolve_term(term, inventory):
+    # Returns list of hosts of one term of the pattern or None if it can't be resolved
+    kind = term_kind(term, inventory)
+    if kind == TERM_HOST:
+        return [term]
+    if inventory is None:
+        return None
+    if kind == TERM_ALL:
+        return inventory.group_hosts('all')
+    if kind == TERM_GROUP:
+        return inventory.group_hosts(term)
+    if kind == TERM_REGEXP:
+        regexp = re.compile(term[1:])
+        return [x for x in inventory.hosts if regexp.match(x)]
+    return [x for x in inventory.hosts if fnmatch.fnmatchcase(x, term)]
+
+
+def resolve_hosts(hosts, inventory=None):
+    """
+    hosts: str - ansible hosts pattern ('host1.domain.ru:web-*.domain.ru:!web-3.domain.ru')
+    inventory: Inventory | None - without inventory only lists of host names can be resolved
+    Returns list of hosts in the order of the pattern or None if the pattern can't be resolved
+    """
+    if not hosts:
+        return None
+    included = []
+    intersections = []
+    excluded = set()
+    for term in hosts.replace(',', ':').split(':'):
+        term = term.strip()
+        if not term:
+            continue
+        if term[0] in ('!', '&'):
+            resolved = _resolve_term(term[1:], inventory)
+        else:
+            resolved = _resolve_term(term, inventory)
+        if resolved is None:
+            return None
+        if term[0] == '!':
+            excluded.update(resolved)
+        elif term[0] == '&':
+            intersections.append(set(resolved))
+        else:
+            included.extend(resolved)
+    result = []
+    seen = set()
+    for host in included:
+        if host in seen or host in excluded:
+            continue
+        if any(host not in x for x in intersections):
+            continue
+        seen.add(host)
+        result.append(host)
+    return result
+
+
+def split_hosts(hosts, count):
+    # Splits hosts into at most 'count' contiguous parts of almost equal size
+    count = min(count, len(hosts))
+    size, rest = divmod(len(hosts), count)
+    result = []
+    start = 0
+    for i in range(count):
+        end = start + size + (1 if i < rest else 0)
+        result.append(hosts[start:end])
+        start = end
+    return result
+
+
+def shard_task(task, config):
+    """
+    Splits hosts of the task (deployment.Task) into config['shards'] parts
+    Returns list of tasks limited by the parts of hosts (disjoint '-l') or None if the task isn't sharded:
+    no hosts limit (nolimit), hosts can't be resolved or there are less than two hosts
+    """
+    shards = config.get('shards') or 1
+    hosts = task.get('hosts')
+    if shards < 2 or not hosts or task.play.get('shard'):
+        return None
+    inventory = None
+    if config.get('inventory'):
+        inventory = load_inventory(config['inventory'])
+    resolved = resolve_hosts(hosts, inventory)
+    if resolved is None:
+        logger.warning("Hosts '{}' can't be resolved without inventory, playbook {} isn't sharded".format(
+            hosts, task['playbook']))
+        return None
+    if len(resolved) < 2:
+        return None
+    parts = split_hosts(resolved, shards)
+    logger.debug('Playbook {}: {} hosts in {} shards'.format(task['playbook'], len(resolved), len(parts)))
+    return [task.with_hosts(':'.join(part), '{}/{}'.format(i + 1, len(parts))) for i, part in enumerate(parts)]